@@ -0,0 +1,377 @@
+# encoding=utf8
+'''Benchmarks'''
+# Copyright 2014 by Christopher Foo <chris.foo@gmail.com>
+# Licensed under GPLv3. See COPYING.txt for details.
+from __future__ import (print_function, absolute_import, unicode_literals,
+    with_statement)
+from compfacts import corpus
+from compfacts.grammar import (FactBuilder, CompiledGrammar, produce,
+    FACT_SYMBOLS)
+from compfacts.posting import (Database, escape_for_twitter, fact_hash,
+    DEFAULT_PAGE_SIZE)
+import argparse
+import compfacts
+import json
+import logging
+import nltk
+import os.path
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+import timeit
+import tornado.httpserver
+
+
+_logger = logging.getLogger(__name__)
+
+
+def measure(func, number, repeat=3):
+    '''Time the function and return the best result.
+
+    Returns:
+        dict: ``seconds`` is the best total time of ``number`` calls and
+        ``rate`` is the number of calls per second.
+    '''
+
+    seconds = min(timeit.repeat(func, number=number, repeat=repeat))
+
+    return {
+        'number': number,
+        'seconds': seconds,
+        'rate': number / seconds if seconds else float('inf'),
+    }
+
+
+def measure_latency(func, number):
+    '''Time each call of the function.
+
+    Returns:
+        dict: ``seconds`` is the total time of ``number`` calls, ``rate`` is
+        the number of calls per second and the remaining keys are the
+        minimum, maximum and percentiles of the call times.
+    '''
+
+    timer = timeit.default_timer
+    latencies = []
+
+    for dummy in xrange(number):
+        start_time = timer()
+        func()
+        latencies.append(timer() - start_time)
+
+    latencies.sort()
+    seconds = sum(latencies)
+
+    return {
+        'number': number,
+        'seconds': seconds,
+        'rate': number / seconds if seconds else float('inf'),
+        'min': latencies[0],
+        'p50': percentile(latencies, 0.5),
+        'p90': percentile(latencies, 0.9),
+        'p99': percentile(latencies, 0.99),
+        'max': latencies[-1],
+    }
+
+
+def percentile(sorted_values, fraction):
+    '''Return the nearest-rank percentile of the sorted values.'''
+
+    index = int(round(fraction * len(sorted_values) + 0.5)) - 1
+
+    return sorted_values[min(max(index, 0), len(sorted_values) - 1)]
+
+
+def build_recursive_grammar(fact_builder):
+    '''Return a NLTK grammar that includes the corpus text lines.
+
+    This is the grammar that :func:`.grammar.produce` needs because it
+    does not know about corpus indexes.
+    '''
+
+    buf = fact_builder.build_grammar_text()
+
+    for name, filename in corpus.get_corpus_text_names():
+        for line in open(filename, 'rb'):
+            line = line.strip().decode('utf8')
+
+            if line.startswith(u'#') or not line:
+                continue
+
+            buf.write(u'%s -> "%s"\n' % (name,
+                corpus.CorpusIndex.format_line(line)))
+
+    return nltk.parse_cfg(buf.getvalue().encode('utf8'))
+
+
+def build_deep_grammar(depth):
+    '''Return a NLTK grammar whose only sentence is nested to the depth.'''
+
+    lines = [b"N%d -> 'x' N%d" % (index, index + 1)
+        for index in xrange(depth)]
+    lines.append(b"N%d -> 'x'" % depth)
+
+    return nltk.parse_cfg(b'\n'.join(lines))
+
+
+def benchmark_produce(fact_builder, number=1000):
+    '''Compare the recursive generator producer with the compiled
+    explicit stack producer.'''
+
+    grammar = build_recursive_grammar(fact_builder)
+    compiled_grammar = CompiledGrammar(grammar)
+    start = grammar.start()
+
+    recursive = measure(lambda: u''.join(produce(grammar, start)), number)
+    stack = measure(lambda: compiled_grammar.produce(), number)
+    stack['speedup'] = stack['rate'] / recursive['rate']
+
+    return {'recursive': recursive, 'stack': stack}
+
+
+def benchmark_deep_produce(depth=5000, number=10):
+    '''Compare the producers on a grammar deeper than the recursion
+    limit.'''
+
+    grammar = build_deep_grammar(depth)
+    compiled_grammar = CompiledGrammar(grammar)
+    start = grammar.start()
+    results = {'depth': depth, 'recursion_limit': sys.getrecursionlimit()}
+
+    try:
+        results['recursive'] = measure(
+            lambda: u''.join(produce(grammar, start)), number)
+    except RuntimeError as error:
+        results['recursive'] = {'error': unicode(error)}
+
+    results['stack'] = measure(lambda: compiled_grammar.produce(), number)
+
+    return results
+
+
+def benchmark_init(number=3):
+    '''Time building the grammar with and without the cache.'''
+
+    temp_dir = tempfile.mkdtemp()
+    cache_path = os.path.join(temp_dir, 'grammar.cache')
+
+    try:
+        results = {'build': measure_latency(FactBuilder, number)}
+        FactBuilder(cache_path=cache_path)
+        results['cached'] = measure_latency(
+            lambda: FactBuilder(cache_path=cache_path), number)
+    finally:
+        shutil.rmtree(temp_dir)
+
+    return results
+
+
+def benchmark_fact(fact_builder, number=1000, max_length=120):
+    '''Time :meth:`.FactBuilder.fact` for each kind of fact.'''
+
+    results = {}
+
+    for symbol in (None,) + FACT_SYMBOLS:
+        results[symbol or 'start'] = measure_latency(
+            lambda: fact_builder.fact(max_length=max_length, symbol=symbol),
+            number)
+
+    return results
+
+
+def benchmark_escape(fact_builder, number=10000):
+    '''Time :func:`.posting.escape_for_twitter` on generated facts.'''
+
+    facts = [fact_builder.fact() for dummy in xrange(1000)]
+    iterator = iter(facts * (number // len(facts) + 1))
+
+    return measure_latency(lambda: escape_for_twitter(next(iterator)),
+        number)
+
+
+def populate_database(database, rows):
+    '''Insert the number of facts, one per second up to now.'''
+
+    start_timestamp = int(time.time()) - rows
+
+    def row_generator():
+        for index in xrange(rows):
+            fact = 'Benchmark fact {0}.'.format(index)
+
+            yield (start_timestamp + index, fact, fact_hash(fact))
+
+    with database.connection() as con:
+        con.executemany('INSERT INTO facts (timestamp, fact, fact_hash) '
+            'VALUES (?, ?, ?)', row_generator())
+
+
+def benchmark_database(rows=(10000, 100000, 1000000), number=200):
+    '''Time inserting and paging facts in databases of the sizes.'''
+
+    results = {}
+
+    for row_count in rows:
+        temp_dir = tempfile.mkdtemp()
+
+        try:
+            database = Database(os.path.join(temp_dir, 'benchmark.db'))
+            populate_database(database, row_count)
+
+            middle_page = database.get_facts(
+                int(time.time()) - row_count // 2)[-1]
+            counter = iter(xrange(number))
+
+            results[unicode(row_count)] = {
+                'insert_fact': measure_latency(
+                    lambda: database.insert_fact(
+                        'New benchmark fact {0}.'.format(next(counter))),
+                    number),
+                'get_facts': measure_latency(database.get_facts, number),
+                'get_facts_deep': measure_latency(
+                    lambda: database.get_facts(middle_page[0],
+                        middle_page[2]),
+                    number),
+            }
+
+            database.close()
+        finally:
+            shutil.rmtree(temp_dir)
+
+    return results
+
+
+def benchmark_feed(number=200):
+    '''Time rendering an Atom feed page without the feed cache.'''
+
+    from compfacts.web import Application, AtomFeedHandler
+
+    temp_dir = tempfile.mkdtemp()
+
+    try:
+        database = Database(os.path.join(temp_dir, 'benchmark.db'))
+        populate_database(database, DEFAULT_PAGE_SIZE)
+
+        application = Application(database)
+        request = tornado.httpserver.HTTPRequest('GET',
+            '/compfacts/compfacts.atom', host='localhost')
+        handler = AtomFeedHandler(application, request)
+        rows = database.get_facts()
+
+        results = {
+            'render': measure_latency(lambda: handler._render_feed(rows),
+                number),
+            'query_and_render': measure_latency(
+                lambda: handler._render_feed(database.get_facts()), number),
+        }
+
+        application.executor.shutdown()
+        database.close()
+    finally:
+        shutil.rmtree(temp_dir)
+
+    return results
+
+
+def compare_results(results, baseline, path=()):
+    '''Return tuples of the path and the ratio of the rates.'''
+
+    ratios = []
+
+    for key, value in sorted(results.items()):
+        baseline_value = baseline.get(key)
+
+        if not isinstance(value, dict) or not isinstance(baseline_value,
+        dict):
+            continue
+
+        if 'rate' in value and baseline_value.get('rate'):
+            ratios.append((path + (key,),
+                value['rate'] / baseline_value['rate']))
+        else:
+            ratios.extend(compare_results(value, baseline_value,
+                path + (key,)))
+
+    return ratios
+
+
+def print_results(name, results, indent=0):
+    '''Print the nested results dict.'''
+
+    print(u'%s%s:' % (u'  ' * indent, name))
+
+    for key, value in sorted(results.items()):
+        if isinstance(value, dict):
+            print_results(key, value, indent + 1)
+        else:
+            print(u'%s%s: %s' % (u'  ' * (indent + 1), key, value))
+
+
+BENCHMARKS = ('init', 'fact', 'escape', 'database', 'feed', 'produce',
+    'deep_produce')
+'''Names of the benchmarks in the order they run.'''
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(
+        description='Runs CompFacts benchmarks.')
+    arg_parser.add_argument('--number', type=int, default=1000,
+        help='Number of calls per measurement')
+    arg_parser.add_argument('--seed', type=int, default=1,
+        help='Random seed')
+    arg_parser.add_argument('--benchmark', action='append',
+        choices=BENCHMARKS, help='Run only this benchmark (repeatable)')
+    arg_parser.add_argument('--rows', type=int, nargs='+',
+        default=[10000, 100000, 1000000],
+        help='Database sizes for the database benchmark')
+    arg_parser.add_argument('--output', help='Write the results as JSON')
+    arg_parser.add_argument('--compare',
+        help='JSON results of a previous run to compare rates against')
+
+    args = arg_parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    random.seed(args.seed)
+
+    names = args.benchmark or BENCHMARKS
+    fact_builder = FactBuilder()
+    benchmarks = {
+        'init': lambda: benchmark_init(),
+        'fact': lambda: benchmark_fact(fact_builder, args.number),
+        'escape': lambda: benchmark_escape(fact_builder, args.number * 10),
+        'database': lambda: benchmark_database(args.rows,
+            max(1, args.number // 5)),
+        'feed': lambda: benchmark_feed(max(1, args.number // 5)),
+        'produce': lambda: benchmark_produce(fact_builder, args.number),
+        'deep_produce': lambda: benchmark_deep_produce(),
+    }
+    results = {}
+
+    for name in BENCHMARKS:
+        if name in names:
+            results[name] = benchmarks[name]()
+            print_results(name, results[name])
+
+    if args.output:
+        with open(args.output, 'wb') as file:
+            json.dump({
+                'version': compfacts.__version__,
+                'python': platform.python_version(),
+                'timestamp': time.time(),
+                'results': results,
+            }, file, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare, 'rb') as file:
+            baseline = json.load(file)
+
+        print('Rate compared to {0}:'.format(baseline['version']))
+
+        for path, ratio in compare_results(results, baseline['results']):
+            print('  {0}: {1:.2f}x'.format('.'.join(path), ratio))
+
+
+if __name__ == '__main__':
+    main()
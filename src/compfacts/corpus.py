@@ -4,15 +4,28 @@
 # Licensed under GPLv3. See COPYING.txt for details.
 from __future__ import print_function
 import argparse
+import array
+import bisect
+import bz2
 import datetime
 import glob
+import gzip
+import heapq
+import itertools
 import logging
+import mmap
 import os.path
 import re
 import sys
+import tempfile
+import xml.parsers.expat
 
 _logger = logging.getLogger(__name__)
 
+MAX_OPEN_RUNS = 64
+'''Maximum number of temporary files merged at once by
+:func:`sort_unique`.'''
+
 
 class WikiNameListExtractor(object):
     '''Extracts names from Wikipedia lists Wikitext'''
@@ -118,23 +131,713 @@ class WikiNameListExtractor(object):
             except EOFError:
                 break
 
-            name = self.extract_line(line)
+            self.add_line(line, filter_text)
 
-            if filter_text and name and filter_text.lower() in name.lower():
-                continue
+        _logger.info('Extract finish')
 
-            if name:
-                self._names.add(name)
+    def add_line(self, line, filter_text=None):
+        '''Extract a name from the next line of wikitext and keep it.'''
 
-            self._prev_line = line
+        name = self.extract_line(line)
 
-        _logger.info('Extract finish')
+        if name and not (filter_text
+        and filter_text.lower() in name.lower()):
+            self._names.add(name)
+
+        self._prev_line = line
+
+    @property
+    def names(self):
+        '''The set of names extracted since the last reset.'''
+
+        return self._names
 
     def print_out(self):
         for name in sorted(self._names):
             print(name.encode('utf8'))
 
 
+class WikiDumpReader(object):
+    '''Extracts names from list pages of a MediaWiki XML dump.
+
+    The dump may be compressed with bzip2 (including multistream dumps) or
+    gzip. It is parsed incrementally and the page text is given to
+    :class:`WikiNameListExtractor` line by line, so memory use does not
+    depend on the size of the dump or its pages.
+
+    Args:
+        title_filter: A function that accepts a page title and returns
+            whether the page is read.
+        filter_text (unicode): Names containing this text are skipped.
+    '''
+
+    CHUNK_SIZE = 262144
+
+    def __init__(self, title_filter, filter_text=None):
+        self._title_filter = title_filter
+        self._filter_text = filter_text
+
+    def read(self, path):
+        '''Read the dump file.
+
+        Returns:
+            iterator: Tuples of page title and set of names for each
+            selected page.
+        '''
+
+        parser = _WikiDumpParser(self._title_filter, self._filter_text)
+
+        for chunk in iter_dump_chunks(path, self.CHUNK_SIZE):
+            parser.feed(chunk)
+
+            for page in parser.pop_pages():
+                yield page
+
+        parser.feed(b'', True)
+
+        for page in parser.pop_pages():
+            yield page
+
+
+class _WikiDumpParser(object):
+    '''Expat handlers for :class:`WikiDumpReader`.'''
+
+    def __init__(self, title_filter, filter_text):
+        self._title_filter = title_filter
+        self._filter_text = filter_text
+        self._parser = xml.parsers.expat.ParserCreate()
+        self._parser.buffer_text = True
+        self._parser.StartElementHandler = self._start_element
+        self._parser.EndElementHandler = self._end_element
+        self._parser.CharacterDataHandler = self._character_data
+        self._title = None
+        self._title_parts = None
+        self._extractor = None
+        self._line_parts = None
+        self._pages = []
+
+    def feed(self, data, is_final=False):
+        self._parser.Parse(data, is_final)
+
+    def pop_pages(self):
+        pages = self._pages
+        self._pages = []
+
+        return pages
+
+    def _start_element(self, name, attrs):
+        if name == 'page':
+            self._title = None
+            self._extractor = None
+        elif name == 'title':
+            self._title_parts = []
+        elif name == 'text' and self._title \
+        and self._title_filter(self._title):
+            _logger.info('Reading page %s', self._title)
+
+            if not self._extractor:
+                self._extractor = WikiNameListExtractor()
+
+            self._extractor.reset()
+            self._line_parts = []
+
+    def _end_element(self, name):
+        if name == 'title' and self._title_parts is not None:
+            self._title = u''.join(self._title_parts)
+            self._title_parts = None
+        elif name == 'text' and self._line_parts is not None:
+            self._extractor.add_line(u''.join(self._line_parts),
+                self._filter_text)
+            self._line_parts = None
+        elif name == 'page' and self._extractor:
+            self._pages.append((self._title, self._extractor.names))
+            self._extractor = None
+
+    def _character_data(self, data):
+        if self._title_parts is not None:
+            self._title_parts.append(data)
+        elif self._line_parts is not None:
+            lines = data.split(u'\n')
+
+            if len(lines) == 1:
+                self._line_parts.append(data)
+                return
+
+            self._line_parts.append(lines[0])
+            self._extractor.add_line(u''.join(self._line_parts),
+                self._filter_text)
+
+            for line in lines[1:-1]:
+                self._extractor.add_line(line, self._filter_text)
+
+            self._line_parts = [lines[-1]]
+
+
+def iter_dump_chunks(path, chunk_size=262144):
+    '''Return an iterator of decompressed chunks of the file.
+
+    Files ending in ``.bz2`` or ``.gz`` are decompressed. Bzip2 files may
+    consist of several streams.
+    '''
+
+    if path.endswith('.bz2'):
+        return _iter_bz2_chunks(path, chunk_size)
+    elif path.endswith('.gz'):
+        return _iter_file_chunks(gzip.GzipFile(path, 'rb'), chunk_size)
+    else:
+        return _iter_file_chunks(open(path, 'rb'), chunk_size)
+
+
+def _iter_file_chunks(file, chunk_size):
+    with file:
+        while True:
+            data = file.read(chunk_size)
+
+            if not data:
+                break
+
+            yield data
+
+
+def _iter_bz2_chunks(path, chunk_size):
+    decompressor = bz2.BZ2Decompressor()
+
+    for data in _iter_file_chunks(open(path, 'rb'), chunk_size):
+        while data:
+            try:
+                yield decompressor.decompress(data)
+            except EOFError:
+                # The previous stream ended; the rest is the next stream
+                decompressor = bz2.BZ2Decompressor()
+                continue
+
+            data = decompressor.unused_data
+
+            if data:
+                decompressor = bz2.BZ2Decompressor()
+
+
+def get_page_slug(title):
+    '''Return the page title shortened for a corpus text filename.
+
+    For example, ``List of computer-animated films`` becomes
+    ``computer-animated_films``.
+    '''
+
+    title = re.sub(r'^list of ', u'', title.strip().lower())
+
+    return re.sub(r'[^\w-]', u'', title.replace(u' ', u'_'), flags=re.UNICODE)
+
+
+def get_wikipedia_corpus_filenames(directory):
+    '''Return a dict of lowercase page titles to Wikipedia list corpus
+    text filenames in the directory and its subdirectories.
+
+    The title is read from the ``# Title:`` header if present. Otherwise,
+    it is guessed from the slug in a filename such as
+    ``programmer.wp.programmers.corpus_text``.
+    '''
+
+    filenames = {}
+
+    for dir_path, dir_names, names in os.walk(directory):
+        for name in names:
+            parts = name.split(u'.')
+
+            # Files split by merge_corpus_files() are not refreshed
+            if len(parts) != 4 or parts[1] != u'wp' \
+            or parts[-1] != u'corpus_text':
+                continue
+
+            filename = os.path.join(dir_path, name)
+            title = read_corpus_title(filename) \
+                or u'list of %s' % parts[2].replace(u'_', u' ')
+
+            filenames[title.lower()] = filename
+
+    return filenames
+
+
+def read_corpus_title(filename):
+    '''Return the page title in the corpus text file header or None.'''
+
+    with open(filename, 'rb') as file:
+        for line in file:
+            if not line.startswith(b'#'):
+                break
+
+            line = line.decode('utf8')
+
+            if line.startswith(u'# Title:'):
+                return line.split(u':', 1)[1].strip()
+
+
+def write_corpus_text(filename, title, names):
+    '''Write the sorted names with a header crediting the page.'''
+
+    with open(filename, 'wb') as file:
+        file.write(b'# Extracted from Wikipedia, The Free Encyclopedia\n')
+        file.write(b'# License CC-BY-SA\n')
+        file.write(b'# Date extracted: %s\n'
+            % datetime.datetime.utcnow().isoformat())
+        file.write(u'# Title: {0}\n'.format(title).encode('utf8'))
+
+        for name in sorted(names):
+            file.write(name.encode('utf8'))
+            file.write(b'\n')
+
+
+def extract_wikipedia_dump(path, output_dir, name=None, title_pattern=None,
+filter_text=None):
+    '''Write a corpus text file for each list page in the dump.
+
+    If `name` and `title_pattern` are given, pages with matching titles
+    are written to ``NAME.wp.SLUG.corpus_text`` in the output directory.
+    Otherwise, the existing Wikipedia list corpus text files in the
+    output directory are replaced.
+
+    Returns:
+        list: The filenames written.
+    '''
+
+    if name:
+        title_re = re.compile(title_pattern or u'^List of ', re.UNICODE)
+        filenames = None
+        title_filter = title_re.search
+    else:
+        filenames = get_wikipedia_corpus_filenames(output_dir)
+        title_filter = lambda title: title.lower() in filenames
+
+    written_filenames = []
+
+    for title, names in WikiDumpReader(title_filter, filter_text).read(path):
+        if filenames is None:
+            filename = os.path.join(output_dir, u'%s.wp.%s.corpus_text'
+                % (name, get_page_slug(title)))
+        else:
+            filename = filenames[title.lower()]
+
+        if not names:
+            _logger.warning('No names found in %s', title)
+            continue
+
+        _logger.info('Writing %s names to %s', len(names), filename)
+        write_corpus_text(filename, title, names)
+        written_filenames.append(filename)
+
+    return written_filenames
+
+
+def iter_corpus_lines(filename):
+    '''Return an iterator of the stripped lines of the corpus text file.
+
+    Comments and blank lines are skipped.
+    '''
+
+    with open(filename, 'rb') as file:
+        for line in file:
+            line = line.strip()
+
+            if line and not line.startswith(b'#'):
+                yield line.decode('utf8')
+
+
+def read_corpus_header(filename):
+    '''Return the comment lines at the start of the corpus text file.'''
+
+    header = []
+
+    with open(filename, 'rb') as file:
+        for line in file:
+            if not line.startswith(b'#'):
+                break
+
+            header.append(line.rstrip().decode('utf8'))
+
+    return header
+
+
+def sort_unique(lines, max_lines=100000):
+    '''Return an iterator of the sorted lines without case-insensitive
+    duplicates.
+
+    An external merge sort is used: at most `max_lines` lines are sorted in
+    memory at once and sorted runs are kept in temporary files. Of lines
+    differing only by case, the one that sorts first is kept.
+    '''
+
+    runs = []
+    lines = iter(lines)
+
+    while True:
+        chunk = list(itertools.islice(lines, max_lines))
+        is_last_chunk = len(chunk) < max_lines
+        chunk = _sorted_unique_chunk(chunk)
+
+        if is_last_chunk and not runs:
+            return iter(chunk)
+
+        if chunk:
+            runs.append(_write_run(chunk))
+
+        if is_last_chunk:
+            break
+
+    return _merge_runs(runs)
+
+
+def _sorted_unique_chunk(lines):
+    chunk = []
+    previous_key = None
+
+    for line in sorted(lines, key=lambda line: (line.lower(), line)):
+        key = line.lower()
+
+        if key != previous_key:
+            chunk.append(line)
+            previous_key = key
+
+    return chunk
+
+
+def _write_run(lines):
+    file = tempfile.TemporaryFile(prefix='tmp-compfacts-', suffix='.run')
+
+    for line in lines:
+        file.write(line.encode('utf8'))
+        file.write(b'\n')
+
+    file.seek(0)
+
+    return file
+
+
+def _iter_run(file):
+    with file:
+        for line in file:
+            line = line[:-1].decode('utf8')
+
+            yield (line.lower(), line)
+
+
+def _merge_runs(runs):
+    while len(runs) > MAX_OPEN_RUNS:
+        merged_runs = runs[:MAX_OPEN_RUNS]
+        runs = runs[MAX_OPEN_RUNS:]
+        runs.append(_write_run(_merge_runs(merged_runs)))
+
+    previous_key = None
+
+    for key, line in heapq.merge(*[_iter_run(file) for file in runs]):
+        if key != previous_key:
+            yield line
+            previous_key = key
+
+
+def get_shard_filename(filename, index):
+    '''Return the filename with the split number as the META_DATA.
+
+    For example, shard 1 of ``game.wp.c64_games.corpus_text`` is
+    ``game.wp.c64_games.1.corpus_text``.
+    '''
+
+    base, extension = os.path.splitext(filename)
+
+    return u'%s.%d%s' % (base, index, extension)
+
+
+def merge_corpus_files(input_filenames, output_filename, shard_lines=None,
+max_lines=100000):
+    '''Merge the corpus text files into one sorted file without duplicates.
+
+    Names are compared case-insensitively. The header of the output
+    credits the inputs and keeps their license lines.
+
+    Args:
+        input_filenames (list): The corpus text files to read.
+        output_filename (str): The corpus text file to write.
+        shard_lines (int): If given, write files of at most this many lines
+            named using :func:`get_shard_filename`.
+        max_lines (int): The number of lines sorted in memory at once.
+
+    Returns:
+        list: The filenames written.
+    '''
+
+    header = [u'# Merged from: %s' % u', '.join(
+        os.path.basename(filename) for filename in input_filenames)]
+
+    for filename in input_filenames:
+        for line in read_corpus_header(filename):
+            if line.startswith(u'# License') and line not in header:
+                header.append(line)
+
+    lines = sort_unique(itertools.chain.from_iterable(
+        iter_corpus_lines(filename) for filename in input_filenames),
+        max_lines)
+
+    if not shard_lines:
+        _write_lines(output_filename, header, lines)
+
+        return [output_filename]
+
+    output_filenames = []
+
+    for index in itertools.count(1):
+        shard = list(itertools.islice(lines, shard_lines))
+
+        if not shard:
+            break
+
+        filename = get_shard_filename(output_filename, index)
+        _write_lines(filename, header, shard)
+        output_filenames.append(filename)
+
+    return output_filenames
+
+
+def _write_lines(filename, header, lines):
+    _logger.info('Writing %s', filename)
+
+    with open(filename, 'wb') as file:
+        for line in itertools.chain(header, lines):
+            file.write(line.encode('utf8'))
+            file.write(b'\n')
+
+
+class CorpusIndex(object):
+    '''Random access to the lines of one or more corpus text files.
+
+    Only the offsets and lengths of the lines are kept in memory. The
+    files are memory-mapped and a line is decoded only when it is
+    requested. Comments and blank lines are skipped.
+
+    The files must not be edited in place while the index is in use.
+    Replace a file by renaming a new copy over it instead; the mapping
+    keeps the old file.
+
+    Filenames may be relative to :func:`get_corpus_data_dir`.
+    '''
+
+    def __init__(self):
+        self._filenames = []
+        self._offsets = []
+        self._lengths = []
+        self._maps = []
+        self._cumulative_counts = []
+        self._count = 0
+        self._length_order = None
+        self._sorted_lengths = None
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self._count
+
+        if not 0 <= index < self._count:
+            raise IndexError('corpus index out of range')
+
+        file_index = bisect.bisect_right(self._cumulative_counts, index)
+
+        if file_index:
+            index -= self._cumulative_counts[file_index - 1]
+
+        map_obj = self._maps[file_index]
+        start = self._offsets[file_index][index]
+        end = map_obj.find(b'\n', start)
+
+        if end == -1:
+            end = len(map_obj)
+
+        return self.format_line(map_obj[start:end].strip().decode('utf8'))
+
+    @property
+    def min_length(self):
+        '''The length of the shortest formatted line.'''
+
+        return int(min(min(lengths) for lengths in self._lengths if lengths))
+
+    @property
+    def max_length(self):
+        '''The length of the longest formatted line.'''
+
+        return int(max(max(lengths) for lengths in self._lengths if lengths))
+
+    def count_fitting(self, max_length):
+        '''Return the number of lines not longer than the length.'''
+
+        if self._sorted_lengths is None:
+            self._sort_lengths()
+
+        return bisect.bisect_right(self._sorted_lengths, max_length)
+
+    def get_fitting(self, index):
+        '''Return a line by its position in the ordering by length.
+
+        Positions less than :meth:`count_fitting` are lines that fit.
+        '''
+
+        return self[self.get_fitting_index(index)]
+
+    def get_fitting_index(self, index):
+        '''Return the index of a line by its position in the ordering by
+        length.'''
+
+        if self._length_order is None:
+            self._sort_lengths()
+
+        return self._length_order[index]
+
+    def _sort_lengths(self):
+        lengths = array.array('L')
+
+        for file_lengths in self._lengths:
+            lengths.extend(file_lengths)
+
+        self._length_order = array.array('L',
+            sorted(xrange(len(lengths)), key=lengths.__getitem__))
+        self._sorted_lengths = array.array('L',
+            (lengths[index] for index in self._length_order))
+
+    @classmethod
+    def format_line(cls, line):
+        '''Return the line as it appears in a fact.'''
+
+        return line.replace(u'"', u'“').upper()
+
+    def add_file(self, filename):
+        '''Index the lines of the file.'''
+
+        offsets = array.array('L')
+        lengths = array.array('L')
+        offset = 0
+        path = os.path.join(get_corpus_data_dir(), filename)
+
+        # The lines are read from the file that is mapped even if it is
+        # replaced meanwhile
+        with open(path, 'rb') as file:
+            for line in file:
+                stripped_line = line.strip()
+
+                if stripped_line and not stripped_line.startswith(b'#'):
+                    if b'"' in stripped_line:
+                        _logger.warn(u'Corpus %s contains double quote',
+                            stripped_line.decode('utf8'))
+
+                    offsets.append(offset)
+                    lengths.append(len(self.format_line(
+                        stripped_line.decode('utf8'))))
+
+                offset += len(line)
+
+            if offsets:
+                map_obj = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                map_obj = b''
+
+        self._append(filename, offsets, lengths, map_obj)
+
+    def _append(self, filename, offsets, lengths, map_obj=None):
+        self._filenames.append(filename)
+        self._offsets.append(offsets)
+        self._lengths.append(lengths)
+        self._length_order = None
+        self._sorted_lengths = None
+
+        if map_obj is None:
+            map_obj = self._map_file(filename, offsets)
+
+        self._maps.append(map_obj)
+        self._count += len(offsets)
+        self._cumulative_counts.append(self._count)
+
+    @property
+    def filenames(self):
+        '''The indexed filenames in order.'''
+
+        return list(self._filenames)
+
+    @classmethod
+    def reindex(cls, corpus_index, filenames, changed_filenames):
+        '''Return a new index of the files.
+
+        The lines of files that are indexed by `corpus_index` and not in
+        `changed_filenames` are reused without reading the files. The
+        old index shares their memory maps so it must not be closed while
+        the new one is in use.
+
+        Args:
+            corpus_index (CorpusIndex): The old index or None.
+            filenames (list): The files of the new index.
+            changed_filenames (set): The files to read again.
+        '''
+
+        if corpus_index is not None:
+            entries = dict((filename, entry) for filename, entry in zip(
+                corpus_index._filenames, zip(corpus_index._offsets,
+                corpus_index._lengths, corpus_index._maps)))
+        else:
+            entries = {}
+
+        new_index = cls()
+
+        for filename in filenames:
+            if filename in entries and filename not in changed_filenames:
+                new_index._append(filename, *entries[filename])
+            else:
+                new_index.add_file(filename)
+
+        return new_index
+
+    @classmethod
+    def _map_file(cls, filename, offsets):
+        if not offsets:
+            return b''
+
+        path = os.path.join(get_corpus_data_dir(), filename)
+
+        with open(path, 'rb') as file:
+            map_obj = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        last_offset = offsets[-1]
+
+        # The offsets were read from an earlier version of the file
+        if last_offset >= len(map_obj) \
+        or last_offset and map_obj[last_offset - 1] != b'\n':
+            map_obj.close()
+            raise ValueError(
+                u'Corpus file {0} changed since it was indexed'.format(
+                    filename))
+
+        return map_obj
+
+    def close(self):
+        '''Unmap the files.'''
+
+        for map_obj in self._maps:
+            if isinstance(map_obj, mmap.mmap):
+                map_obj.close()
+
+        self._maps = []
+
+    def __getstate__(self):
+        return (self._filenames, self._offsets, self._lengths)
+
+    def __setstate__(self, state):
+        self.__init__()
+
+        for filename, offsets, lengths in zip(*state):
+            self._append(filename, offsets, lengths)
+
+
+def get_corpus_data_dir():
+    '''Return the directory containing the corpus and grammar files.'''
+
+    return os.path.join(os.path.dirname(__file__), u'corpus_data')
+
+
 def get_corpus_text_names():
     '''Return corpus name and filename pairs.
 
@@ -145,7 +848,7 @@ def get_corpus_text_names():
     Where META_DATA can be an integer to split large files.
     '''
 
-    path = os.path.join(os.path.dirname(__file__), u'corpus_data', u'*')
+    path = os.path.join(get_corpus_data_dir(), u'*')
     pattern = u'%s/*.corpus_text' % path
 
     for filename in glob.glob(pattern):
@@ -160,7 +863,24 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser('Corpus Text Extractor')
     parser.add_argument('--wikipedia-list', action='store_true', default=False,
         help='Read wikitext from standard input')
+    parser.add_argument('--wikipedia-dump',
+        help='Read list pages from a MediaWiki XML dump (.xml, .bz2, .gz)')
+    parser.add_argument('--name',
+        help='Nonterminal name of corpus text files written from the dump. '
+        'If omitted, existing Wikipedia list files are refreshed')
+    parser.add_argument('--title-pattern',
+        help='Regular expression of page titles to read from the dump')
+    parser.add_argument('--output-dir', default=get_corpus_data_dir(),
+        help='Directory of corpus text files written from the dump')
     parser.add_argument('--filter', type=unicode, default=None)
+    parser.add_argument('--merge', metavar='OUTPUT',
+        help='Merge the input corpus text files into a sorted file '
+        'without duplicates')
+    parser.add_argument('--shard-lines', type=int,
+        help='Split the merged file into files of this many lines')
+    parser.add_argument('--max-lines', type=int, default=100000,
+        help='Number of lines sorted in memory when merging')
+    parser.add_argument('inputs', nargs='*', help='Corpus text files')
 
     args = parser.parse_args()
 
@@ -168,5 +888,13 @@ if __name__ == '__main__':
         e = WikiNameListExtractor()
         e.extract(filter_text=args.filter)
         e.print_out()
+    elif args.wikipedia_dump:
+        extract_wikipedia_dump(args.wikipedia_dump, args.output_dir,
+            name=args.name, title_pattern=args.title_pattern and
+            args.title_pattern.decode('utf8'),
+            filter_text=args.filter)
+    elif args.merge:
+        merge_corpus_files(args.inputs, args.merge,
+            shard_lines=args.shard_lines, max_lines=args.max_lines)
     else:
         parser.print_help()
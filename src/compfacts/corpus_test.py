@@ -0,0 +1,177 @@
+# encoding=utf-8
+
+from compfacts import corpus
+from compfacts.corpus import (WikiDumpReader, get_page_slug,
+    extract_wikipedia_dump, iter_dump_chunks, sort_unique,
+    merge_corpus_files)
+import bz2
+import gzip
+import os.path
+import re
+import shutil
+import tempfile
+import unittest
+
+
+TEST_DUMP = u"""<mediawiki xmlns="http://www.mediawiki.org/xml/export-0.8/">
+  <page>
+    <title>List of programmers</title>
+    <revision>
+      <text xml:space="preserve">Some programmers:
+* [[Ada Lovelace]] – first programmer
+* [[Grace Hopper]], compilers
+* '''Renée Example''' (born 1950)
+</text>
+    </revision>
+  </page>
+  <page>
+    <title>Kittens</title>
+    <revision>
+      <text xml:space="preserve">* [[Not A Name]]</text>
+    </revision>
+  </page>
+  <page>
+    <title>List of computer-animated films</title>
+    <revision>
+      <text xml:space="preserve">{| class="wikitable"
+|-
+| ''[[Toy Story]]'' || 1995
+|}</text>
+    </revision>
+  </page>
+</mediawiki>
+""".encode('utf8')
+
+
+class TestWikiDumpReader(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def write_dump(self, filename):
+        path = os.path.join(self.temp_dir, filename)
+
+        if filename.endswith('.bz2'):
+            # Split into several streams like a multistream dump
+            middle = len(TEST_DUMP) // 2
+
+            with open(path, 'wb') as file:
+                file.write(bz2.compress(TEST_DUMP[:middle]))
+                file.write(bz2.compress(TEST_DUMP[middle:]))
+        else:
+            with gzip.GzipFile(path, 'wb') as file:
+                file.write(TEST_DUMP)
+
+        return path
+
+    def test_read(self):
+        for filename in ('dump.xml.bz2', 'dump.xml.gz'):
+            path = self.write_dump(filename)
+
+            self.assertEqual(b''.join(iter_dump_chunks(path, 10)), TEST_DUMP)
+
+            reader = WikiDumpReader(re.compile(r'^List of ').search)
+            reader.CHUNK_SIZE = 7
+            pages = list(reader.read(path))
+
+            self.assertEqual(pages, [
+                (u'List of programmers', set([u'Ada Lovelace',
+                    u'Grace Hopper', u'Renée Example'])),
+                (u'List of computer-animated films', set([u'Toy Story'])),
+            ])
+
+    def test_page_slug(self):
+        self.assertEqual(get_page_slug(u'List of computer-animated films'),
+            u'computer-animated_films')
+        self.assertEqual(get_page_slug(u'List of fictional hackers'),
+            u'fictional_hackers')
+
+    def test_extract_wikipedia_dump(self):
+        path = self.write_dump('dump.xml.gz')
+        filenames = extract_wikipedia_dump(path, self.temp_dir,
+            name=u'programmer', title_pattern=u'programmers')
+
+        self.assertEqual(filenames, [os.path.join(self.temp_dir,
+            u'programmer.wp.programmers.corpus_text')])
+
+        with open(filenames[0], 'wb') as file:
+            file.write(b'# Args: --wikipedia-list\nnobody\n')
+
+        # Refresh the existing file using the title guessed from its name
+        self.assertEqual(extract_wikipedia_dump(path, self.temp_dir),
+            filenames)
+
+        with open(filenames[0], 'rb') as file:
+            lines = file.read().decode('utf8').splitlines()
+
+        self.assertIn(u'# Title: List of programmers', lines)
+        self.assertEqual([line for line in lines if not line.startswith('#')],
+            [u'Ada Lovelace', u'Grace Hopper', u'Renée Example'])
+
+
+class TestMerge(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_sort_unique(self):
+        lines = [u'b', u'A', u'a', u'C', u'b', u'B', u'\xe9', u'\xc9', u'd']
+        expected = [u'A', u'B', u'C', u'd', u'\xc9']
+
+        self.assertEqual(list(sort_unique(lines)), expected)
+
+        for max_lines in (1, 2, 3, 9):
+            self.assertEqual(list(sort_unique(lines, max_lines=max_lines)),
+                expected)
+
+    def test_many_runs(self):
+        original_max_open_runs = corpus.MAX_OPEN_RUNS
+        corpus.MAX_OPEN_RUNS = 3
+
+        try:
+            lines = [unicode(index % 50) for index in range(200)]
+
+            self.assertEqual(list(sort_unique(lines, max_lines=7)),
+                sorted(set(lines)))
+        finally:
+            corpus.MAX_OPEN_RUNS = original_max_open_runs
+
+    def test_merge_corpus_files(self):
+        input_filenames = []
+
+        for index, text in enumerate([b'# License CC-BY-SA\nZork\nPong\n',
+        b'# comment\n\npong\nAsteroids\nzork\nTetris\n']):
+            filename = os.path.join(self.temp_dir,
+                'game.wp.games_%d.corpus_text' % index)
+            input_filenames.append(filename)
+
+            with open(filename, 'wb') as file:
+                file.write(text)
+
+        output_filename = os.path.join(self.temp_dir,
+            'game.wp.games.corpus_text')
+        filenames = merge_corpus_files(input_filenames, output_filename,
+            shard_lines=3)
+
+        self.assertEqual(filenames, [
+            os.path.join(self.temp_dir, 'game.wp.games.1.corpus_text'),
+            os.path.join(self.temp_dir, 'game.wp.games.2.corpus_text'),
+        ])
+
+        with open(filenames[0], 'rb') as file:
+            self.assertEqual(file.read(),
+                b'# Merged from: game.wp.games_0.corpus_text, '
+                b'game.wp.games_1.corpus_text\n'
+                b'# License CC-BY-SA\n'
+                b'Asteroids\nPong\nTetris\n')
+
+        with open(filenames[1], 'rb') as file:
+            self.assertTrue(file.read().endswith(b'\nZork\n'))
+
+
+if __name__ == "__main__":
+    unittest.main()
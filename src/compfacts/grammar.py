@@ -5,36 +5,106 @@
 from __future__ import (print_function, absolute_import, unicode_literals,
     with_statement)
 from StringIO import StringIO
-from compfacts import corpus
+from compfacts import corpus, metrics
+import argparse
+import bisect
+import cPickle
+import collections
+import compfacts
 import glob
+import hashlib
+import itertools
+import json
 import logging
+import multiprocessing
 import nltk
+import os
 import os.path
 import random
+import sys
+import tempfile
+import threading
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 _logger = logging.getLogger(__name__)
 
+FACT_SYMBOLS = ('fact', 'fact2', 'fact3', 'protip', 'qna')
+'''Nonterminals of the top-level kinds of facts.'''
+
+MAX_UNIFORM_ATTEMPTS = 1000
+'''Maximum number of uniform sentences generated to find one that fits
+within a length.'''
+
+Derivation = collections.namedtuple('Derivation', ['grammar_version', 'data'])
+'''The production choices that generated a fact.
+
+Attributes:
+    grammar_version (str): The version of the grammar that made the
+        choices. The choices can be decoded to text only by the same
+        version, but they can be counted by any version with the same
+        structure version as described in :func:`get_grammar_version`.
+    data (str): The choices encoded with :func:`encode_varints`. The
+        first number is the ID of the starting nonterminal.
+'''
+
+_fact_seconds = metrics.REGISTRY.histogram('compfacts_fact_seconds',
+    'Time taken by FactBuilder.fact()')
+_reloads_total = metrics.REGISTRY.counter('compfacts_grammar_reloads_total',
+    'Grammar reloads after corpus data changed', labels={'result': 'ok'})
+_failed_reloads_total = metrics.REGISTRY.counter(
+    'compfacts_grammar_reloads_total',
+    'Grammar reloads after corpus data changed', labels={'result': 'error'})
+
 
 class FactBuilder(object):
-    '''Computer facts builder.'''
+    '''Computer facts builder.
 
-    def __init__(self):
-        self._grammar = self.build_grammar()
-        self._nonterminal = self._grammar.start()
-        check_grammar(self._grammar, self._nonterminal)
+    The grammar is replaced as a whole by :meth:`reload`, so facts being
+    generated keep using the grammar they started with.
 
-    def build_grammar_text(self):
-        '''Return the context-free grammar represented as a string.'''
+    Args:
+        cache_path: If given, the filename of the compiled grammar cache.
+            The cache is used when the corpus data is unchanged and
+            rewritten otherwise.
+    '''
 
-        buf = StringIO()
+    def __init__(self, cache_path=None):
+        self._cache_path = cache_path
+        self._compiled_grammar = None
+        self._grammar_productions = {}
+        self._file_stats = get_corpus_data_stats()
+        self._failed_file_stats = None
+        version = get_grammar_version()
+
+        if cache_path:
+            self._compiled_grammar = load_compiled_grammar(cache_path, version)
+
+        if not self._compiled_grammar:
+            self._compiled_grammar = self.build_compiled_grammar(version)
+
+            if cache_path:
+                save_compiled_grammar(cache_path, self._compiled_grammar)
+
+    @property
+    def grammar_version(self):
+        '''The digest of the corpus data used to build the grammar.'''
+
+        return self._compiled_grammar.version
+
+    def build_grammar_text(self):
+        '''Return the context-free grammar represented as a string.
 
-        grammar_path = os.path.join(os.path.dirname(__file__), 'corpus_data',
-            'compfacts.grammar_text')
+        The corpus text files are not included.
+        '''
 
-        paths = [grammar_path] + list(get_grammar_text_filenames())
+        buf = StringIO()
 
-        for path in paths:
+        for path in get_all_grammar_text_filenames():
             _logger.debug(u'Loading %s', path)
 
             for line in open(path, 'rb'):
@@ -46,41 +116,1313 @@ class FactBuilder(object):
                 buf.write(line)
                 buf.write(u'\n')
 
+        return buf
+
+    def build_grammar(self):
+        '''Use the grammar text files and return a NLTK grammar.'''
+
+        grammer_def = self.build_grammar_text().getvalue()
+        grammar = nltk.parse_cfg(grammer_def.encode('utf8'))
+
+        return grammar
+
+    def build_compiled_grammar(self, version=None):
+        '''Use the corpus data and return a checked compiled grammar.'''
+
+        compiled_grammar = CompiledGrammar(self.build_grammar(), version)
+        corpus_data_dir = corpus.get_corpus_data_dir()
+
         for name, filename in corpus.get_corpus_text_names():
             _logger.debug(u'Loading %s from %s', name, filename)
+            compiled_grammar.add_corpus(name,
+                os.path.relpath(filename, corpus_data_dir))
 
-            for line in open(filename, 'rb'):
-                line = line.strip().decode('utf8')
+        compiled_grammar.check()
+        compiled_grammar.compute_lengths()
 
-                if line.startswith(u'#') or not line:
+        return compiled_grammar
+
+    def reload(self):
+        '''Rebuild the grammar if the corpus data files changed.
+
+        Only changed grammar text files are parsed again and only the
+        corpora of changed corpus text files are indexed again. The new
+        grammar is checked before it replaces the current one. If the
+        check fails, the current grammar is kept until the files change
+        again.
+
+        This method must not be called by more than one thread at a time.
+
+        Returns:
+            bool: True if the grammar was replaced.
+        '''
+
+        file_stats = get_corpus_data_stats()
+
+        if file_stats == self._file_stats \
+        or file_stats == self._failed_file_stats:
+            return False
+
+        changed_paths = set(path for path in
+            set(file_stats) | set(self._file_stats)
+            if file_stats.get(path) != self._file_stats.get(path))
+
+        _logger.info('Reloading grammar, changed files: %s',
+            ', '.join(sorted(changed_paths)))
+
+        try:
+            version = get_grammar_version()
+
+            if version == self.grammar_version:
+                self._file_stats = file_stats
+                return False
+
+            compiled_grammar = self._build_changed_grammar(changed_paths,
+                version)
+        except (EmptyProductionsError, ValueError, IOError, OSError):
+            _logger.exception('Grammar reload failed, keeping version %s',
+                self.grammar_version)
+            _failed_reloads_total.inc()
+            self._failed_file_stats = file_stats
+            return False
+
+        self._compiled_grammar = compiled_grammar
+        self._file_stats = file_stats
+        self._failed_file_stats = None
+        _reloads_total.inc()
+        _logger.info('Reloaded grammar version %s', version)
+
+        if self._cache_path:
+            save_compiled_grammar(self._cache_path, compiled_grammar)
+
+        return True
+
+    def _build_changed_grammar(self, changed_paths, version):
+        old_grammar = self._compiled_grammar
+
+        if any(path.endswith('.grammar_text') for path in changed_paths):
+            compiled_grammar = CompiledGrammar(self._build_grammar_cached(),
+                version)
+        else:
+            compiled_grammar = old_grammar.copy(version)
+
+        corpus_data_dir = corpus.get_corpus_data_dir()
+        changed_filenames = set(os.path.relpath(path, corpus_data_dir)
+            for path in changed_paths)
+        corpus_filenames = collections.OrderedDict(
+            (name, []) for name in old_grammar.get_corpus_names())
+
+        for name, filename in corpus.get_corpus_text_names():
+            corpus_filenames.setdefault(name, []).append(
+                os.path.relpath(filename, corpus_data_dir))
+
+        for name, filenames in corpus_filenames.iteritems():
+            old_index = old_grammar.get_corpus(name)
+
+            if old_index is not None and old_index.filenames == filenames \
+            and not changed_filenames.intersection(filenames):
+                corpus_index = old_index
+            elif filenames:
+                _logger.debug(u'Indexing corpus %s', name)
+                corpus_index = corpus.CorpusIndex.reindex(old_index,
+                    filenames, changed_filenames)
+            else:
+                corpus_index = None
+
+            compiled_grammar.set_corpus(name, corpus_index)
+
+        compiled_grammar.check()
+        compiled_grammar.compute_lengths()
+
+        return compiled_grammar
+
+    def _build_grammar_cached(self):
+        '''Return a NLTK grammar, parsing only the grammar text files not
+        parsed before.'''
+
+        productions = []
+
+        for path in get_all_grammar_text_filenames():
+            file_stat = get_file_stat(path)
+            cached = self._grammar_productions.get(path)
+
+            if not cached or cached[0] != file_stat:
+                _logger.debug(u'Parsing %s', path)
+                cached = (file_stat, parse_grammar_file(path))
+                self._grammar_productions[path] = cached
+
+            productions.extend(cached[1])
+
+        if not productions:
+            raise ValueError('The grammar has no productions')
+
+        return nltk.grammar.ContextFreeGrammar(productions[0].lhs(),
+            productions, False)
+
+    def fact(self, max_length=None, uniform=False, symbol=None, rng=random):
+        '''Return one computer fact.
+
+        Args:
+            max_length (int): If given, the fact is generated to be no
+                longer than the length.
+            uniform (bool): If True, the fact is chosen uniformly from all
+                facts as described in
+                :meth:`CompiledGrammar.count_derivations`. Facts longer
+                than `max_length` are rejected and chosen again up to
+                :data:`MAX_UNIFORM_ATTEMPTS` times.
+            symbol (str): If given, the nonterminal to generate instead of
+                the start symbol, such as one of :data:`FACT_SYMBOLS`.
+            rng: If given, a :class:`random.Random` instance used instead
+                of the module level generator.
+        '''
+
+        with _fact_seconds.time():
+            return self._fact(max_length, uniform, symbol, rng)
+
+    def _fact(self, max_length, uniform, symbol, rng):
+        compiled_grammar = self._compiled_grammar
+
+        if symbol is None:
+            nonterminal_id = compiled_grammar.start
+        else:
+            nonterminal_id = compiled_grammar.get_id(symbol)
+
+        if uniform:
+            return compiled_grammar.produce_uniform(nonterminal_id, rng=rng,
+                max_length=max_length)
+        else:
+            return compiled_grammar.produce(nonterminal_id, rng=rng,
+                max_length=max_length)
+
+    def fact_with_derivation(self, max_length=None, symbol=None,
+    rng=random):
+        '''Return one computer fact and its :class:`Derivation`.
+
+        See :meth:`fact` for the arguments.
+        '''
+
+        compiled_grammar = self._compiled_grammar
+
+        if symbol is None:
+            nonterminal_id = compiled_grammar.start
+        else:
+            nonterminal_id = compiled_grammar.get_id(symbol)
+
+        choices = [nonterminal_id]
+
+        with _fact_seconds.time():
+            fact = compiled_grammar.produce(nonterminal_id, rng, max_length,
+                choices=choices)
+
+        return (fact,
+            Derivation(compiled_grammar.version, encode_varints(choices)))
+
+    def decode_derivation(self, derivation):
+        '''Return the fact text of the :class:`Derivation`.
+
+        Raises:
+            ValueError: The derivation is from another grammar version or
+                is corrupt.
+        '''
+
+        compiled_grammar = self._compiled_grammar
+
+        if derivation.grammar_version != compiled_grammar.version:
+            raise ValueError('Derivation is from grammar version %s'
+                % derivation.grammar_version)
+
+        choices = decode_varints(derivation.data)
+
+        return compiled_grammar.replay(choices[1:], choices[0])
+
+    def count_choices(self, derivations):
+        '''Count the productions and corpora chosen by the derivations.
+
+        Derivations from grammar versions with another structure version
+        are skipped. The corpus text files may have changed since.
+
+        Returns:
+            collections.Counter: Counts keyed by tuples of the nonterminal
+            symbol and the index of its production. The index is None
+            for a line of the nonterminal's corpus.
+        '''
+
+        compiled_grammar = self._compiled_grammar
+        structure_version = get_structure_version(compiled_grammar.version)
+        counts = collections.Counter()
+
+        for derivation in derivations:
+            if get_structure_version(derivation.grammar_version) \
+            != structure_version:
+                continue
+
+            choices = decode_varints(derivation.data)
+            compiled_grammar.replay(choices[1:], choices[0], counts=counts,
+                render=False)
+
+        names = compiled_grammar.names
+        result = collections.Counter()
+
+        for (nonterminal_id, index), count in counts.iteritems():
+            if index >= len(compiled_grammar.productions[nonterminal_id]):
+                index = None
+
+            result[(names[nonterminal_id], index)] += count
+
+        return result
+
+    def facts(self, count, seed=None, uniform=False):
+        '''Return a list of computer facts.
+
+        When NumPy is available, the random choices are drawn in bulk
+        which is faster than calling :meth:`fact` repeatedly.
+
+        Args:
+            count (int): The number of facts.
+            seed: If given, an int or a tuple of ints used to seed a
+                private random number generator.
+            uniform (bool): If True, choose facts uniformly. See
+                :meth:`fact`.
+        '''
+
+        compiled_grammar = self._compiled_grammar
+
+        if numpy is None or uniform:
+            rng = random.Random(seed) if seed is not None else random
+
+            if uniform:
+                produce_func = compiled_grammar.produce_uniform
+            else:
+                produce_func = compiled_grammar.produce
+
+            return [produce_func(rng=rng) for dummy in xrange(count)]
+
+        if seed is not None:
+            random_state = numpy.random.RandomState(
+                list(seed) if isinstance(seed, tuple) else seed)
+        else:
+            random_state = None
+
+        return compiled_grammar.produce_batch(count,
+            random_state=random_state)
+
+    def derivation_report(self):
+        '''Return the number of derivations of each nonterminal.
+
+        See :meth:`CompiledGrammar.derivation_report`.
+        '''
+
+        return self._compiled_grammar.derivation_report()
+
+
+class CompiledGrammar(object):
+    '''A NLTK grammar compiled into an integer-indexed form.
+
+    Nonterminals are numbered and their productions are stored as tuples
+    in a list indexed by the nonterminal ID. Each item of a production is
+    one of:
+
+    * :class:`int`: the ID of a nonterminal
+    * :class:`unicode`: a decoded terminal
+    * :class:`float`: the probability of a ``__CONTINUEnn__`` nonterminal
+
+    Corpus text lines are not productions. They are kept in a
+    :class:`.corpus.CorpusIndex` per nonterminal and each line is as
+    likely to be chosen as each production.
+
+    Attributes:
+        names (list): The nonterminal symbols indexed by ID.
+        productions (list): The production tuples indexed by ID.
+        corpora (list): The :class:`.corpus.CorpusIndex` or None indexed
+            by ID.
+        start (int): The ID of the start nonterminal.
+        version (str): The digest of the corpus data, if known.
+        min_lengths (list): The shortest rendered length indexed by ID.
+            Available after :meth:`compute_lengths`.
+        max_lengths (list): The longest rendered length indexed by ID.
+            It is infinite for unbounded recursion.
+            Available after :meth:`compute_lengths`.
+    '''
+
+    FORMAT_VERSION = 5
+    '''Version of the attributes layout stored in the cache.'''
+
+    def __init__(self, grammar, version=None):
+        self.version = version
+        self.names = []
+        self.productions = []
+        self.corpora = []
+        self.min_lengths = None
+        self.max_lengths = None
+        self._ids = {}
+        self._reachable = None
+        self._derivation_info = {}
+
+        for production in grammar.productions():
+            if is_continue_symbol(production.lhs().symbol()):
+                continue
+
+            nonterminal_id = self._get_id(production.lhs().symbol())
+            items = tuple(self._compile_item(item)
+                for item in production.rhs())
+
+            self.productions[nonterminal_id].append(items)
+
+        self.start = self._get_id(grammar.start().symbol())
+
+    def _get_id(self, symbol):
+        nonterminal_id = self._ids.get(symbol)
+
+        if nonterminal_id is None:
+            nonterminal_id = len(self.names)
+            self._ids[symbol] = nonterminal_id
+            self.names.append(symbol)
+            self.productions.append([])
+            self.corpora.append(None)
+
+        return nonterminal_id
+
+    def _compile_item(self, item):
+        if not isinstance(item, nltk.grammar.Nonterminal):
+            return item.decode('utf8')
+
+        if is_continue_symbol(item.symbol()):
+            return parse_continue_symbol(item.symbol())
+
+        return self._get_id(item.symbol())
+
+    def add_corpus(self, symbol, filename):
+        '''Add the lines of a corpus text file to the nonterminal.'''
+
+        nonterminal_id = self._get_id(symbol)
+
+        if self.corpora[nonterminal_id] is None:
+            self.corpora[nonterminal_id] = corpus.CorpusIndex()
+
+        self.corpora[nonterminal_id].add_file(filename)
+
+    def get_corpus(self, symbol):
+        '''Return the :class:`.corpus.CorpusIndex` of the nonterminal or
+        None.'''
+
+        nonterminal_id = self._ids.get(symbol)
+
+        if nonterminal_id is not None:
+            return self.corpora[nonterminal_id]
+
+    def get_corpus_names(self):
+        '''Return the symbols of the nonterminals with a corpus.'''
+
+        return [self.names[nonterminal_id] for nonterminal_id, corpus_index
+            in enumerate(self.corpora) if corpus_index is not None]
+
+    def set_corpus(self, symbol, corpus_index):
+        '''Replace the corpus of the nonterminal.
+
+        Call :meth:`check` and :meth:`compute_lengths` afterwards.
+        '''
+
+        if corpus_index is None and symbol not in self._ids:
+            return
+
+        self.corpora[self._get_id(symbol)] = corpus_index
+
+    def copy(self, version=None):
+        '''Return a grammar sharing the productions but not the corpora.
+
+        Lengths must be computed again for the copy.
+        '''
+
+        compiled_grammar = CompiledGrammar.__new__(CompiledGrammar)
+        compiled_grammar.version = version
+        compiled_grammar.names = list(self.names)
+        compiled_grammar.productions = [list(productions)
+            for productions in self.productions]
+        compiled_grammar.corpora = list(self.corpora)
+        compiled_grammar.start = self.start
+        compiled_grammar.min_lengths = None
+        compiled_grammar.max_lengths = None
+        compiled_grammar._ids = dict(self._ids)
+        compiled_grammar._reachable = None
+        compiled_grammar._derivation_info = {}
+
+        return compiled_grammar
+
+    def check(self):
+        '''Check that no reachable nonterminal is empty.
+
+        :raises: :class:`EmptyProductionsError`
+        '''
+
+        visited = set([self.start])
+        stack = [(self.start, None)]
+
+        while stack:
+            nonterminal_id, parent_symbol = stack.pop()
+
+            if not self.productions[nonterminal_id] \
+            and not self.corpora[nonterminal_id]:
+                raise EmptyProductionsError(
+                    'nonterminal %s has no rhs productions, lhs=%s' % (
+                    self.names[nonterminal_id], parent_symbol))
+
+            for production in self.productions[nonterminal_id]:
+                for item in production:
+                    if type(item) is int and item not in visited:
+                        visited.add(item)
+                        stack.append((item, self.names[nonterminal_id]))
+
+    def compute_lengths(self):
+        '''Compute the shortest and longest rendered length of every
+        nonterminal.
+
+        The lengths are computed by iterating to a fixed point, visiting
+        nonterminals in reverse order since they are numbered in order of
+        first use and referenced ones tend to come later. Since a
+        ``__CONTINUEnn__`` may prune the rest of a production, the shortest
+        length of a production only counts the items before the first one.
+        Nonterminals that can recurse while adding text are found first and
+        given an infinite longest length so the iteration terminates.
+        '''
+
+        infinity = float('inf')
+        count = len(self.names)
+        min_lengths = [infinity] * count
+        max_lengths = [-infinity] * count
+        corpus_min_lengths = [corpus_index.min_length if corpus_index
+            else infinity for corpus_index in self.corpora]
+        corpus_max_lengths = [corpus_index.max_length if corpus_index
+            else -infinity for corpus_index in self.corpora]
+
+        def item_length(item, lengths):
+            if type(item) is int:
+                return lengths[item]
+            elif type(item) is float:
+                return 0
+            else:
+                return len(item)
+
+        def production_min_length(production):
+            length = 0
+
+            for item in production:
+                if type(item) is float:
+                    break
+
+                length += item_length(item, min_lengths)
+
+            return length
+
+        def production_max_length(production):
+            if any(type(item) is int and min_lengths[item] == infinity
+            for item in production):
+                return -infinity
+
+            return sum(item_length(item, max_lengths) for item in production)
+
+        changed = True
+
+        while changed:
+            changed = False
+
+            for nonterminal_id in reversed(xrange(count)):
+                value = min([corpus_min_lengths[nonterminal_id]] + [
+                    production_min_length(production)
+                    for production in self.productions[nonterminal_id]])
+
+                if value < min_lengths[nonterminal_id]:
+                    min_lengths[nonterminal_id] = value
+                    changed = True
+
+        for nonterminal_id in self._find_unbounded(min_lengths):
+            max_lengths[nonterminal_id] = infinity
+
+        changed = True
+
+        while changed:
+            changed = False
+
+            for nonterminal_id in reversed(xrange(count)):
+                value = max([corpus_max_lengths[nonterminal_id]] + [
+                    production_max_length(production)
+                    for production in self.productions[nonterminal_id]])
+
+                if value > max_lengths[nonterminal_id]:
+                    max_lengths[nonterminal_id] = value
+                    changed = True
+
+        self.min_lengths = min_lengths
+        self.max_lengths = max_lengths
+        self._production_orders = []
+        self._sorted_min_lengths = []
+        self._reserved_productions = []
+
+        for productions in self.productions:
+            production_min_lengths = [production_min_length(production)
+                for production in productions]
+            order = sorted(xrange(len(productions)),
+                key=production_min_lengths.__getitem__)
+
+            self._production_orders.append(order)
+            self._sorted_min_lengths.append(
+                [production_min_lengths[index] for index in order])
+            self._reserved_productions.append([
+                tuple(zip(production, self._compute_reserves(production)))
+                for production in productions])
+
+    def _find_unbounded(self, min_lengths):
+        '''Return the IDs of nonterminals that can derive themselves along
+        with other nonempty text.
+
+        Only productions whose nonterminals can all be derived are used.
+        '''
+
+        count = len(self.names)
+        usable_productions = [
+            [production for production in productions
+            if all(type(item) is not int or min_lengths[item] != float('inf')
+            for item in production)]
+            for productions in self.productions]
+        nonempty = [bool(corpus_index) for corpus_index in self.corpora]
+        reachable = _compute_reachable(usable_productions)
+
+        def is_nonempty(item):
+            if type(item) is int:
+                return nonempty[item]
+            elif type(item) is float:
+                return False
+            else:
+                return bool(item)
+
+        changed = True
+
+        while changed:
+            changed = False
+
+            for nonterminal_id in reversed(xrange(count)):
+                if nonempty[nonterminal_id]:
                     continue
 
-                if u'"' in line:
-                    _logger.warn(u'Corpus %s contains double quote', line)
-                    line = line.replace(u'"', u'“')
+                for production in usable_productions[nonterminal_id]:
+                    if any(is_nonempty(item) for item in production):
+                        nonempty[nonterminal_id] = True
+                        changed = True
+                        break
 
-                buf.write(name)
-                buf.write(u' -> ')
-                buf.write(u'"')
-                buf.write(line.upper())
-                buf.write(u'"\n')
+        unbounded = []
 
-        return buf
+        for nonterminal_id, productions in enumerate(usable_productions):
+            for production in productions:
+                for index, item in enumerate(production):
+                    if type(item) is not int or (item != nonterminal_id
+                    and not reachable[item] >> nonterminal_id & 1):
+                        continue
 
-    def build_grammar(self):
-        '''Use the corpus data and return a NLTK grammar.'''
+                    others = production[:index] + production[index + 1:]
 
-        grammer_def = self.build_grammar_text().getvalue()
-        grammar = nltk.parse_cfg(grammer_def.encode('utf8'))
+                    if any(is_nonempty(other) for other in others):
+                        unbounded.append(nonterminal_id)
+                        break
+                else:
+                    continue
+
+                break
+
+        return unbounded
+
+    def _compute_reserves(self, production):
+        '''Return, for each item, the shortest length of the items that
+        follow it up to the next ``__CONTINUEnn__``.'''
+
+        reserves = []
+        reserve = 0
+
+        for item in reversed(production):
+            reserves.append(reserve)
+
+            if type(item) is float:
+                reserve = 0
+            elif type(item) is int:
+                reserve += self.min_lengths[item]
+            else:
+                reserve += len(item)
+
+        reserves.reverse()
+
+        return tuple(reserves)
+
+    def get_id(self, symbol):
+        '''Return the ID of the nonterminal symbol.'''
+
+        return self._ids[symbol]
+
+    def produce(self, nonterminal_id=None, rng=random, max_length=None,
+    choices=None):
+        '''Generate a random sentence starting from the nonterminal ID.
+
+        The semantics are the same as :func:`produce`.
+
+        Args:
+            nonterminal_id (int): The starting nonterminal ID.
+            rng: The :mod:`random` module or a :class:`random.Random`.
+            max_length (int): If given, only productions and corpus lines
+                that can still fit within the length are chosen.
+            choices (list): If given, the choices made are appended as
+                integers that :meth:`replay` accepts. A nonterminal's
+                choice is the index of its production, or the number of
+                productions plus the index of its corpus line. A
+                ``__CONTINUEnn__`` choice is 1 to continue and 0 to prune.
+
+        Raises:
+            ValueError: No sentence is short enough.
+        '''
+
+        if nonterminal_id is None:
+            nonterminal_id = self.start
+
+        output = []
+
+        if max_length is None:
+            self._produce(nonterminal_id, output, rng, choices)
+        else:
+            if self.min_lengths is None:
+                self.compute_lengths()
+
+            if self.min_lengths[nonterminal_id] > max_length:
+                raise ValueError('No sentence fits within %s characters'
+                    % max_length)
+
+            self._produce_bounded(nonterminal_id, output, rng, max_length,
+                choices)
+
+        return u''.join(output)
+
+    def _produce(self, nonterminal_id, output, rng, choices=None):
+        # The stack holds iterators over the items of the productions being
+        # expanded. A production is pushed when a nonterminal is chosen and
+        # popped when its items run out or a __CONTINUEnn__ prunes it.
+        all_productions = self.productions
+        corpora = self.corpora
+        append_output = output.append
+        stack = [iter((nonterminal_id,))]
+        push = stack.append
+        pop = stack.pop
+
+        while stack:
+            for item in stack[-1]:
+                item_type = type(item)
+
+                if item_type is int:
+                    productions = all_productions[item]
+                    corpus_index = corpora[item]
+
+                    if corpus_index is not None:
+                        index = rng.randrange(
+                            len(productions) + len(corpus_index))
+
+                        if choices is not None:
+                            choices.append(index)
+
+                        if index >= len(productions):
+                            append_output(
+                                corpus_index[index - len(productions)])
+                            continue
+
+                        push(iter(productions[index]))
+                    elif choices is None:
+                        push(iter(rng.choice(productions)))
+                    else:
+                        # Same draw as choice() but the index is needed
+                        index = rng.randrange(len(productions))
+                        choices.append(index)
+                        push(iter(productions[index]))
+
+                    break
+                elif item_type is float:
+                    if rng.random() > item:
+                        if choices is not None:
+                            choices.append(0)
+
+                        pop()
+                        break
+                    elif choices is not None:
+                        choices.append(1)
+                else:
+                    append_output(item)
+            else:
+                pop()
+
+    def _produce_bounded(self, nonterminal_id, output, rng, max_length,
+    choices=None):
+        '''Generate within the length and return the length generated.'''
+
+        # Each frame is the iterator over the items paired with their
+        # reserves, the budget of the production and the length generated
+        # so far. A budget of None means the production always fits.
+        all_productions = self._reserved_productions
+        corpora = self.corpora
+        max_lengths = self.max_lengths
+        stack = [[iter(((nonterminal_id, 0),)), max_length, 0]]
+
+        while stack:
+            frame = stack[-1]
+            budget = frame[1]
+            length = frame[2]
+
+            for item, reserve in frame[0]:
+                item_type = type(item)
+
+                if item_type is int:
+                    productions = all_productions[item]
+                    corpus_index = corpora[item]
+
+                    if budget is not None:
+                        child_budget = budget - length - reserve
+
+                        if max_lengths[item] <= child_budget:
+                            child_budget = None
+                    else:
+                        child_budget = None
+
+                    if child_budget is None:
+                        num_productions = len(productions)
+                        num_lines = len(corpus_index or ())
+                        index = rng.randrange(num_productions + num_lines)
+
+                        if choices is not None:
+                            choices.append(index)
+
+                        if index >= num_productions:
+                            line = corpus_index[index - num_productions]
+                            output.append(line)
+                            length += len(line)
+                            continue
+
+                        production = productions[index]
+                    else:
+                        num_productions = bisect.bisect_right(
+                            self._sorted_min_lengths[item], child_budget)
+
+                        if corpus_index is not None:
+                            num_lines = corpus_index.count_fitting(
+                                child_budget)
+                        else:
+                            num_lines = 0
+
+                        index = rng.randrange(num_productions + num_lines)
+
+                        if index >= num_productions:
+                            line_index = corpus_index.get_fitting_index(
+                                index - num_productions)
+                            line = corpus_index[line_index]
+                            output.append(line)
+                            length += len(line)
+
+                            if choices is not None:
+                                choices.append(len(productions) + line_index)
+
+                            continue
+
+                        index = self._production_orders[item][index]
+                        production = productions[index]
+
+                        if choices is not None:
+                            choices.append(index)
+
+                    frame[2] = length
+                    stack.append([iter(production), child_budget, 0])
+                    break
+                elif item_type is float:
+                    if rng.random() > item or budget is not None \
+                    and length + reserve > budget:
+                        if choices is not None:
+                            choices.append(0)
+
+                        break
+                    elif choices is not None:
+                        choices.append(1)
+                else:
+                    output.append(item)
+                    length += len(item)
+            else:
+                frame[2] = length
+
+            if stack[-1] is frame:
+                stack.pop()
+
+                if stack:
+                    stack[-1][2] += length
+                else:
+                    return length
+
+    def replay(self, choices, nonterminal_id=None, counts=None,
+    render=True):
+        '''Return the sentence of the choices made by :meth:`produce`.
+
+        Args:
+            choices (list): The choices.
+            nonterminal_id (int): The starting nonterminal ID.
+            counts (collections.Counter): If given, the number of times
+                each tuple of nonterminal ID and choice is made is added.
+            render (bool): If False, corpus lines are not looked up, so
+                the corpora may have changed since the choices were made,
+                and None is returned.
+
+        Raises:
+            ValueError: The choices do not match the grammar.
+        '''
+
+        if nonterminal_id is None:
+            nonterminal_id = self.start
+
+        all_productions = self.productions
+        output = []
+        choices = iter(choices)
+        stack = [iter((nonterminal_id,))]
+
+        try:
+            while stack:
+                for item in stack[-1]:
+                    item_type = type(item)
+
+                    if item_type is int:
+                        productions = all_productions[item]
+                        choice = next(choices)
+
+                        if counts is not None:
+                            counts[(item, choice)] += 1
+
+                        if choice >= len(productions):
+                            if render:
+                                output.append(self.corpora[item][
+                                    choice - len(productions)])
+                            elif self.corpora[item] is None:
+                                raise IndexError(choice)
+
+                            continue
+
+                        stack.append(iter(productions[choice]))
+                        break
+                    elif item_type is float:
+                        if not next(choices):
+                            stack.pop()
+                            break
+                    else:
+                        output.append(item)
+                else:
+                    stack.pop()
+        except (StopIteration, IndexError, TypeError):
+            raise ValueError('Choices do not match the grammar')
+
+        if next(choices, None) is not None:
+            raise ValueError('Choices do not match the grammar')
+
+        if render:
+            return u''.join(output)
+
+    def count_derivations(self, nonterminal_id=None):
+        '''Return the number of derivations of the nonterminal.
+
+        Only derivations in which no nonterminal is nested within itself
+        are counted so that recursive rules do not make the count
+        infinite. Each corpus line and each choice of a ``__CONTINUEnn__``
+        to prune or not is a separate derivation. Different derivations
+        may render the same text.
+
+        Returns:
+            long
+        '''
+
+        if nonterminal_id is None:
+            nonterminal_id = self.start
+
+        return self._get_derivation_info(
+            (nonterminal_id, frozenset()))[0]
+
+    def derivation_report(self):
+        '''Return the derivation count of every nonterminal.
+
+        Returns:
+            list: A list of tuples (symbol, count) sorted from the largest
+            count.
+        '''
+
+        report = [(name, self.count_derivations(nonterminal_id))
+            for nonterminal_id, name in enumerate(self.names)]
+
+        report.sort(key=lambda item: item[1], reverse=True)
+
+        return report
+
+    def produce_uniform(self, nonterminal_id=None, rng=random,
+    max_length=None):
+        '''Generate a sentence chosen uniformly from all derivations.
+
+        Productions are weighted by their number of derivations as
+        described in :meth:`count_derivations`. The probabilities of
+        ``__CONTINUEnn__`` are not used; pruning is weighted likewise.
+
+        Args:
+            max_length (int): If given, sentences longer than the length
+                are rejected and generated again. Few derivations of a
+                large grammar may be short, so at most
+                :data:`MAX_UNIFORM_ATTEMPTS` sentences are generated.
+
+        Raises:
+            ValueError: The nonterminal has no derivations or no sentence
+                fitting within the length was generated.
+        '''
+
+        if nonterminal_id is None:
+            nonterminal_id = self.start
+
+        if not self.count_derivations(nonterminal_id):
+            raise ValueError('Nonterminal has no derivations')
+
+        if max_length is None:
+            return self._produce_uniform(nonterminal_id, rng)
+
+        if self.min_lengths is None:
+            self.compute_lengths()
+
+        if self.min_lengths[nonterminal_id] > max_length:
+            raise ValueError('No sentence fits within %s characters'
+                % max_length)
+
+        for dummy in xrange(MAX_UNIFORM_ATTEMPTS):
+            sentence = self._produce_uniform(nonterminal_id, rng)
+
+            if len(sentence) <= max_length:
+                return sentence
+
+        raise ValueError('No uniform sentence fitting within %s characters '
+            'was found in %s attempts' % (max_length, MAX_UNIFORM_ATTEMPTS))
+
+    def _produce_uniform(self, nonterminal_id, rng):
+        output = []
+        # Each frame is the iterator over the items paired with the number
+        # of derivations after a __CONTINUEnn__, the nonterminal ID and its
+        # ancestors in the same strongly connected component.
+        stack = [(iter(((nonterminal_id, None),)), None, None)]
+
+        while stack:
+            frame_iter, parent_id, ancestors = stack[-1]
+
+            for item, num_continued in frame_iter:
+                item_type = type(item)
+
+                if item_type is int:
+                    state = self._get_child_state(parent_id, ancestors, item)
+                    total, num_lines, cumulative_counts, productions = \
+                        self._get_derivation_info(state)
+                    index = rng.randrange(total)
+
+                    if index < num_lines:
+                        output.append(self.corpora[item][index])
+                        continue
+
+                    production_index = bisect.bisect_right(
+                        cumulative_counts, index - num_lines)
+
+                    stack.append((iter(productions[production_index]),
+                        item, state[1]))
+                    break
+                elif item_type is float:
+                    if rng.randrange(1 + num_continued) == num_continued:
+                        stack.pop()
+                        break
+                else:
+                    output.append(item)
+            else:
+                stack.pop()
+
+        return u''.join(output)
+
+    def _get_child_state(self, parent_id, ancestors, nonterminal_id):
+        '''Return the counting state of a nonterminal in a production.
+
+        A state is the nonterminal ID and the frozenset of its ancestors
+        that are in the same strongly connected component. Ancestors in
+        other components cannot be nested within it, so they are omitted.
+
+        Returns:
+            tuple, None: None if the nonterminal is its own ancestor.
+        '''
+
+        if parent_id is None:
+            return (nonterminal_id, frozenset())
+
+        if self._reachable is None:
+            self._reachable = _compute_reachable(self.productions)
+
+        if nonterminal_id == parent_id or (
+        self._reachable[nonterminal_id] >> parent_id & 1
+        and self._reachable[parent_id] >> nonterminal_id & 1):
+            child_ancestors = ancestors | frozenset([parent_id])
+
+            if nonterminal_id in child_ancestors:
+                return
+
+            return (nonterminal_id, child_ancestors)
+
+        return (nonterminal_id, frozenset())
+
+    def _get_derivation_info(self, state):
+        '''Return the derivation counts of the state.
+
+        Returns:
+            tuple: The total count, the number of corpus lines, the
+            cumulative counts of the productions and the productions with
+            each item paired with the count after it if it is a
+            ``__CONTINUEnn__``.
+        '''
+
+        if state is None:
+            return (0, 0, [], [])
+
+        info = self._derivation_info.get(state)
+
+        if info:
+            return info
+
+        # Compute the states after the states they depend on without
+        # recursion. The state graph is acyclic since ancestors only grow
+        # within a component.
+        pending = [state]
+
+        while pending:
+            current_state = pending[-1]
+
+            if current_state in self._derivation_info:
+                pending.pop()
+                continue
+
+            nonterminal_id, ancestors = current_state
+            child_states = {}
+
+            for production in self.productions[nonterminal_id]:
+                for item in production:
+                    if type(item) is int and item not in child_states:
+                        child_states[item] = self._get_child_state(
+                            nonterminal_id, ancestors, item)
+
+            missing_states = [child_state
+                for child_state in child_states.itervalues()
+                if child_state is not None
+                and child_state not in self._derivation_info]
+
+            if missing_states:
+                pending.extend(missing_states)
+                continue
+
+            pending.pop()
+
+            num_lines = len(self.corpora[nonterminal_id] or ())
+            cumulative_counts = []
+            paired_productions = []
+            total = 0
+
+            for production in self.productions[nonterminal_id]:
+                count = 1
+                pairs = []
+
+                for item in reversed(production):
+                    if type(item) is int:
+                        child_state = child_states[item]
+
+                        if child_state is None:
+                            count = 0
+                        else:
+                            count *= self._derivation_info[child_state][0]
+
+                        pairs.append((item, None))
+                    elif type(item) is float:
+                        pairs.append((item, count))
+                        count += 1
+                    else:
+                        pairs.append((item, None))
+
+                pairs.reverse()
+                total += count
+                cumulative_counts.append(total)
+                paired_productions.append(tuple(pairs))
+
+            self._derivation_info[current_state] = (num_lines + total,
+                num_lines, cumulative_counts, paired_productions)
+
+        return self._derivation_info[state]
+
+    def produce_batch(self, count, nonterminal_id=None, random_state=None):
+        '''Generate many random sentences at once using NumPy.
+
+        Choices are drawn in bulk as one array of production indices per
+        nonterminal and consumed as the sentences are expanded.
+
+        Args:
+            count (int): The number of sentences.
+            nonterminal_id (int): The starting nonterminal ID.
+            random_state: An instance of :class:`numpy.random.RandomState`.
+                If not given, the functions of :mod:`numpy.random` are used.
+
+        Returns:
+            list: A list of strings.
+        '''
+
+        if nonterminal_id is None:
+            nonterminal_id = self.start
+
+        draws = _BulkDraws(self, random_state or numpy.random)
+        results = []
+
+        for dummy in xrange(count):
+            output = []
+            self._produce_drawn(nonterminal_id, output, draws)
+            results.append(u''.join(output))
+
+        return results
+
+    def _produce_drawn(self, nonterminal_id, output, draws):
+        all_productions = self.productions
+        choices = draws.choices
+        uniforms = draws.uniforms
+        append_output = output.append
+        stack = [iter((nonterminal_id,))]
+        push = stack.append
+        pop = stack.pop
+
+        while stack:
+            for item in stack[-1]:
+                item_type = type(item)
+
+                if item_type is int:
+                    if not choices[item]:
+                        draws.draw_choices(item)
+
+                    choice = choices[item].pop()
+                    productions = all_productions[item]
+
+                    if choice >= len(productions):
+                        append_output(self.corpora[item][
+                            choice - len(productions)])
+                        continue
+
+                    push(iter(productions[choice]))
+                    break
+                elif item_type is float:
+                    if not uniforms:
+                        draws.draw_uniforms()
+
+                    if uniforms.pop() > item:
+                        pop()
+                        break
+                else:
+                    append_output(item)
+            else:
+                pop()
+
+
+def _compute_reachable(all_productions):
+    '''Return, for each nonterminal ID, a bitset of the IDs reachable
+    through one or more productions.'''
+
+    count = len(all_productions)
+    reachable = [0] * count
+    changed = True
+
+    while changed:
+        changed = False
+
+        for nonterminal_id in reversed(xrange(count)):
+            bits = reachable[nonterminal_id]
+
+            for production in all_productions[nonterminal_id]:
+                for item in production:
+                    if type(item) is int:
+                        bits |= (1 << item) | reachable[item]
+
+            if bits != reachable[nonterminal_id]:
+                reachable[nonterminal_id] = bits
+                changed = True
+
+    return reachable
+
+
+class _BulkDraws(object):
+    '''Random numbers for :meth:`CompiledGrammar.produce_batch`.
+
+    Each nonterminal has a list of production indices, including the
+    corpus lines, that is refilled from NumPy in batches which double in
+    size up to :attr:`MAX_BATCH_SIZE`.
+    '''
+
+    MIN_BATCH_SIZE = 16
+    MAX_BATCH_SIZE = 4096
+
+    def __init__(self, compiled_grammar, random_state):
+        self._random_state = random_state
+        self._totals = []
+        self._batch_sizes = [self.MIN_BATCH_SIZE] * len(
+            compiled_grammar.names)
+        self.choices = [[] for dummy in compiled_grammar.names]
+        self.uniforms = []
+
+        for productions, corpus_index in zip(compiled_grammar.productions,
+        compiled_grammar.corpora):
+            self._totals.append(len(productions) + len(corpus_index or ()))
+
+    def draw_choices(self, nonterminal_id):
+        batch_size = self._batch_sizes[nonterminal_id]
+        self._batch_sizes[nonterminal_id] = min(batch_size * 2,
+            self.MAX_BATCH_SIZE)
+
+        self.choices[nonterminal_id].extend(
+            (self._random_state.random_sample(batch_size)
+            * self._totals[nonterminal_id]).astype(int).tolist())
+
+    def draw_uniforms(self):
+        self.uniforms.extend(
+            self._random_state.random_sample(self.MAX_BATCH_SIZE).tolist())
 
-        return grammar
 
-    def fact(self):
-        '''Return one computer fact.'''
+def encode_varints(values):
+    '''Encode non-negative integers as LEB128 variable-length bytes.
 
-        items = produce(self._grammar, self._nonterminal)
+    Numbers less than 128 take one byte.
+    '''
+
+    data = bytearray()
+
+    for value in values:
+        while value >= 0x80:
+            data.append(value & 0x7f | 0x80)
+            value >>= 7
+
+        data.append(value)
 
-        return u''.join(items)
+    return bytes(data)
+
+
+def decode_varints(data):
+    '''Return the list of integers encoded by :func:`encode_varints`.'''
+
+    values = []
+    value = 0
+    shift = 0
+
+    for byte in bytearray(data):
+        value |= (byte & 0x7f) << shift
+
+        if byte & 0x80:
+            shift += 7
+        else:
+            values.append(value)
+            value = 0
+            shift = 0
+
+    if shift:
+        raise ValueError('Truncated varint')
+
+    return values
 
 
 class EmptyProductionsError(ValueError):
@@ -141,9 +1483,8 @@ def produce(grammar, nonterminal):
     for production_rhs_item in production_rhs:
         if isinstance(production_rhs_item, nltk.grammar.Nonterminal):
 
-            if production_rhs_item.symbol().startswith('__CONTINUE'):
-                prob = int(production_rhs_item.symbol().strip('_CONTINUE')
-                    ) / 100.0
+            if is_continue_symbol(production_rhs_item.symbol()):
+                prob = parse_continue_symbol(production_rhs_item.symbol())
 
                 if random.random() > prob:
                     yield ''
@@ -157,19 +1498,328 @@ def produce(grammar, nonterminal):
             yield production_rhs_item.decode('utf8')
 
 
+def is_continue_symbol(symbol):
+    '''Return whether the symbol is a ``__CONTINUEnn__`` nonterminal.'''
+
+    return symbol.startswith('__CONTINUE')
+
+
+def parse_continue_symbol(symbol):
+    '''Return the probability of a ``__CONTINUEnn__`` nonterminal.'''
+
+    return int(symbol.strip('_CONTINUE')) / 100.0
+
+
 def get_grammar_text_filenames():
     '''Return the grammar text filenames.'''
 
-    path = os.path.join(os.path.dirname(__file__), 'corpus_data', '*')
+    path = os.path.join(corpus.get_corpus_data_dir(), '*')
     pattern = u'%s/*.grammar_text' % path
 
     return glob.glob(pattern)
 
 
-if __name__ == '__main__':
+def get_all_grammar_text_filenames():
+    '''Return the main grammar text filename followed by the others.'''
+
+    grammar_path = os.path.join(corpus.get_corpus_data_dir(),
+        'compfacts.grammar_text')
+
+    return [grammar_path] + list(get_grammar_text_filenames())
+
+
+def parse_grammar_file(path):
+    '''Return the NLTK productions of a grammar text file.'''
+
+    lines = []
+
+    with open(path, 'rb') as file:
+        for line in file:
+            line = line.strip()
+
+            if line and not line.startswith(b'#'):
+                lines.append(line)
+
+    if not lines:
+        return []
+
+    return nltk.parse_cfg(b'\n'.join(lines)).productions()
+
+
+def get_file_stat(path):
+    '''Return a tuple that changes when the file is modified.'''
+
+    file_stat = os.stat(path)
+
+    return (file_stat.st_mtime, file_stat.st_size, file_stat.st_ino)
+
+
+def get_corpus_data_stats():
+    '''Return a dict of grammar and corpus text filenames to
+    :func:`get_file_stat` tuples.'''
+
+    filenames = get_all_grammar_text_filenames() + [
+        filename for dummy, filename in corpus.get_corpus_text_names()]
+    file_stats = {}
+
+    for filename in filenames:
+        try:
+            file_stats[filename] = get_file_stat(filename)
+        except OSError:
+            # The file may be replaced while it is checked
+            file_stats[filename] = None
+
+    return file_stats
+
+
+def get_grammar_version():
+    '''Return digests of the grammar and corpus text files.
+
+    The version is the structure version, a hyphen and a digest of the
+    corpus text files. The structure version is a digest of the grammar
+    text files, the corpus names and the compiled grammar format, which
+    determine the meaning of the choices of a :class:`Derivation`. The
+    whole version includes the package version so that it changes
+    whenever a cached grammar would be stale.
+    '''
+
+    corpus_text_names = sorted(corpus.get_corpus_text_names(),
+        key=lambda item: item[1])
+    structure_hasher = hashlib.sha1()
+
+    structure_hasher.update(b'%d\0' % CompiledGrammar.FORMAT_VERSION)
+    _hash_files(structure_hasher, get_all_grammar_text_filenames())
+
+    for name in sorted(set(name for name, dummy in corpus_text_names)):
+        structure_hasher.update(name.encode('utf8'))
+        structure_hasher.update(b'\0')
+
+    hasher = hashlib.sha1()
+
+    hasher.update(compfacts.__version__.encode('ascii'))
+    hasher.update(b'\0')
+    _hash_files(hasher, [filename for dummy, filename in corpus_text_names])
+
+    return '%s-%s' % (structure_hasher.hexdigest(), hasher.hexdigest())
+
+
+def get_structure_version(grammar_version):
+    '''Return the structure version part of the grammar version.
+
+    See :func:`get_grammar_version`.
+    '''
+
+    if grammar_version is None:
+        return
+
+    return grammar_version.split('-', 1)[0]
+
+
+def _hash_files(hasher, filenames):
+    for filename in filenames:
+        hasher.update(os.path.basename(filename).encode('utf8'))
+        hasher.update(b'\0')
+
+        with open(filename, 'rb') as file:
+            hasher.update(file.read())
+
+        hasher.update(b'\0')
+
+
+def load_compiled_grammar(path, version):
+    '''Return the cached compiled grammar if it matches the version.
+
+    Returns:
+        CompiledGrammar, None: None if the cache is missing or stale.
+    '''
+
+    try:
+        with open(path, 'rb') as file:
+            compiled_grammar = cPickle.load(file)
+    except (IOError, EOFError, cPickle.UnpicklingError, AttributeError,
+    ImportError, TypeError, ValueError):
+        _logger.debug('Compiled grammar cache %s unusable', path,
+            exc_info=True)
+        return
+
+    if getattr(compiled_grammar, 'version', None) != version:
+        _logger.info('Compiled grammar cache %s is stale', path)
+        return
+
+    _logger.info('Loaded compiled grammar cache %s', path)
+
+    return compiled_grammar
+
+
+def save_compiled_grammar(path, compiled_grammar):
+    '''Write the compiled grammar to the cache atomically.'''
+
+    dir_path = os.path.dirname(os.path.abspath(path))
+
+    try:
+        fd, temp_path = tempfile.mkstemp(dir=dir_path, prefix='.tmp-',
+            suffix='.grammar_cache')
+    except (IOError, OSError):
+        _logger.exception('Unable to write compiled grammar cache %s', path)
+        return
+
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            cPickle.dump(compiled_grammar, file, cPickle.HIGHEST_PROTOCOL)
+
+        os.rename(temp_path, path)
+    except (IOError, OSError):
+        _logger.exception('Unable to write compiled grammar cache %s', path)
+
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    else:
+        _logger.info('Saved compiled grammar cache %s', path)
+
+
+class GrammarReloader(threading.Thread):
+    '''Polls the corpus data and reloads the grammar when it changes.
+
+    Args:
+        fact_builder (FactBuilder): The fact builder to reload.
+        interval (float): The number of seconds between polls.
+    '''
+
+    def __init__(self, fact_builder, interval=5):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self._fact_builder = fact_builder
+        self._interval = interval
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self._interval):
+            try:
+                self._fact_builder.reload()
+            except Exception:
+                _logger.exception('Grammar reload failed')
+
+    def stop(self):
+        self._stop_event.set()
+
+
+_worker_fact_builder = None
+
+
+def _init_worker(fact_builder):
+    global _worker_fact_builder
+    _worker_fact_builder = fact_builder
+
+
+def _generate_chunk(args):
+    '''Return the facts of a chunk seeded by the chunk index.'''
+
+    chunk_index, count, seed, uniform = args
+
+    return _worker_fact_builder.facts(count, seed=(seed, chunk_index),
+        uniform=uniform)
+
+
+def generate_facts(fact_builder, count, seed, workers=1, chunk_size=1000,
+uniform=False):
+    '''Generate facts in chunks, optionally in a process pool.
+
+    Each chunk has its own random number generator seeded with the seed
+    and the chunk index so the output does not depend on the number of
+    workers. It does depend on the chunk size. Facts are yielded in order.
+    '''
+
+    chunks = ((chunk_index, min(chunk_size, count - offset), seed, uniform)
+        for chunk_index, offset in enumerate(xrange(0, count, chunk_size)))
+
+    if workers <= 1:
+        _init_worker(fact_builder)
+        results = itertools.imap(_generate_chunk, chunks)
+    else:
+        pool = multiprocessing.Pool(workers, initializer=_init_worker,
+            initargs=(fact_builder,))
+        results = pool.imap(_generate_chunk, chunks)
+
+    try:
+        for facts in results:
+            for fact in facts:
+                yield fact
+    finally:
+        if workers > 1:
+            pool.terminate()
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(
+        description='Generate computer facts.')
+    arg_parser.add_argument('--count', type=int, default=100,
+        help='Number of facts')
+    arg_parser.add_argument('--workers', type=int, default=1,
+        help='Number of worker processes')
+    arg_parser.add_argument('--seed', type=int,
+        help='Random seed for reproducible output with the same chunk size')
+    arg_parser.add_argument('--format', choices=['plain', 'jsonl'],
+        default='plain', help='Output format')
+    arg_parser.add_argument('--chunk-size', type=int, default=1000,
+        help='Number of facts generated per task')
+    arg_parser.add_argument('--grammar-cache',
+        help='Compiled grammar cache file path')
+    arg_parser.add_argument('--uniform', action='store_true', default=False,
+        help='Choose facts uniformly from all possible facts')
+    arg_parser.add_argument('--report', action='store_true', default=False,
+        help='Print the number of derivations of each nonterminal')
+    arg_parser.add_argument('--choice-report', metavar='DATABASE',
+        help='Print how often each production and corpus was chosen by '
+        'the facts posted to the database')
+
+    args = arg_parser.parse_args()
+
     logging.basicConfig(level=logging.DEBUG)
 
-    builder = FactBuilder()
+    if args.report:
+        fact_builder = FactBuilder(cache_path=args.grammar_cache)
+
+        for name, count in fact_builder.derivation_report():
+            print('%s\t%s\t%.3e' % (name, count, count))
 
-    for dummy in xrange(0, 100):
-        print(builder.fact().encode('utf8'))
+        return
+
+    if args.choice_report:
+        # Imported here since the posting module imports this one
+        from compfacts.posting import Database
+
+        fact_builder = FactBuilder(cache_path=args.grammar_cache)
+        database = Database(args.choice_report)
+        counts = fact_builder.count_choices(database.get_derivations(
+            structure_version=get_structure_version(
+                fact_builder.grammar_version)))
+
+        for (name, index), count in sorted(counts.iteritems()):
+            print('%s\t%s\t%s' % (name,
+                'corpus' if index is None else index, count))
+
+        return
+
+    if args.seed is None:
+        seed = random.SystemRandom().randint(0, 2 ** 32 - 1)
+    else:
+        seed = args.seed
+
+    _logger.info('Using seed %s', seed)
+
+    fact_builder = FactBuilder(cache_path=args.grammar_cache)
+    facts = generate_facts(fact_builder, args.count, seed,
+        workers=args.workers, chunk_size=args.chunk_size,
+        uniform=args.uniform)
+
+    for fact in facts:
+        if args.format == 'jsonl':
+            sys.stdout.write(json.dumps({'fact': fact}))
+        else:
+            sys.stdout.write(fact.encode('utf8'))
+
+        sys.stdout.write(b'\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,482 @@
+# encoding=utf-8
+
+from compfacts import corpus
+from compfacts.grammar import (FactBuilder, CompiledGrammar,
+    EmptyProductionsError, parse_continue_symbol, generate_facts,
+    FACT_SYMBOLS, encode_varints, decode_varints, Derivation,
+    GrammarReloader, get_structure_version)
+import cPickle
+import nltk
+import os.path
+import random
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+TEST_GRAMMAR = b'''
+S -> greeting ' ' name __CONTINUE50__ '!'
+greeting -> 'hello'
+greeting -> 'hi'
+name -> 'kitten'
+name -> 'puppy'
+__CONTINUE50__ -> '__ERROR__'
+'''
+
+
+class TestCompiledGrammar(unittest.TestCase):
+    def test_compile(self):
+        grammar = nltk.parse_cfg(TEST_GRAMMAR)
+        compiled = CompiledGrammar(grammar)
+
+        self.assertEqual(compiled.names[compiled.start], 'S')
+        self.assertNotIn('__CONTINUE50__', compiled.names)
+
+        start_productions = compiled.productions[compiled.start]
+
+        self.assertEqual(len(start_productions), 1)
+        self.assertEqual(start_productions[0], (
+            compiled.get_id('greeting'), u' ', compiled.get_id('name'), 0.5,
+            u'!'))
+
+    def test_produce(self):
+        grammar = nltk.parse_cfg(TEST_GRAMMAR)
+        compiled = CompiledGrammar(grammar)
+        facts = set(compiled.produce() for dummy in range(200))
+
+        self.assertEqual(facts, set([
+            u'hello kitten', u'hello kitten!', u'hello puppy',
+            u'hello puppy!', u'hi kitten', u'hi kitten!', u'hi puppy',
+            u'hi puppy!',
+        ]))
+
+    def test_corpus(self):
+        temp_dir = tempfile.mkdtemp()
+
+        try:
+            filename = os.path.join(temp_dir, 'animal.corpus_text')
+
+            with open(filename, 'wb') as file:
+                file.write(b'# comment\n\ncat\ndog "fido"\n\xc3\xa9mu')
+
+            compiled = CompiledGrammar(nltk.parse_cfg(b"S -> 'a ' animal"))
+
+            self.assertRaises(EmptyProductionsError, compiled.check)
+
+            compiled.add_corpus('animal', filename)
+            compiled.check()
+
+            corpus_index = compiled.corpora[compiled.get_id('animal')]
+
+            self.assertEqual(len(corpus_index), 3)
+            self.assertEqual(list(corpus_index),
+                [u'CAT', u'DOG “FIDO“', u'\xc9MU'])
+
+            facts = set(compiled.produce() for dummy in range(100))
+
+            self.assertEqual(facts,
+                set([u'a CAT', u'a DOG “FIDO“', u'a \xc9MU']))
+            corpus_index.close()
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_produce_deep(self):
+        depth = sys.getrecursionlimit() * 2
+        lines = [b"N%d -> 'x' N%d" % (index, index + 1)
+            for index in range(depth)]
+        lines.append(b"N%d -> 'x'" % depth)
+        compiled = CompiledGrammar(nltk.parse_cfg(b'\n'.join(lines)))
+        compiled.compute_lengths()
+
+        self.assertEqual(compiled.produce(), u'x' * (depth + 1))
+        self.assertEqual(compiled.produce(max_length=depth + 1),
+            u'x' * (depth + 1))
+
+    def test_count_derivations(self):
+        grammar = nltk.parse_cfg(b'''
+S -> greeting ' ' name __CONTINUE50__ '!'
+S -> 'well, ' phrase
+phrase -> greeting ' ' name
+phrase -> S
+greeting -> 'hello'
+greeting -> 'hi'
+greeting -> greeting greeting
+name -> 'kitten'
+name -> 'puppy'
+name -> 'cat'
+''')
+        compiled = CompiledGrammar(grammar)
+
+        # Nested within itself: greeting greeting and S within phrase
+        self.assertEqual(
+            compiled.count_derivations(compiled.get_id('greeting')), 2)
+        self.assertEqual(compiled.count_derivations(compiled.get_id('name')),
+            3)
+        self.assertEqual(
+            compiled.count_derivations(compiled.get_id('phrase')), 6 + 12)
+        self.assertEqual(compiled.count_derivations(), 12 + 6)
+        self.assertEqual(dict(compiled.derivation_report())['S'], 18)
+
+        facts = set(compiled.produce_uniform() for dummy in range(1000))
+
+        self.assertEqual(len(facts), 18)
+        self.assertIn(u'well, hi cat', facts)
+        self.assertIn(u'hello kitten!', facts)
+
+    def test_produce_uniform_max_length(self):
+        grammar = nltk.parse_cfg(b"S -> " + b" ".join([b"letter"] * 20)
+            + b"\nletter -> 'x'\nletter -> 'yy'")
+        compiled = CompiledGrammar(grammar)
+
+        self.assertLessEqual(len(compiled.produce_uniform(max_length=30)), 30)
+        self.assertRaises(ValueError, compiled.produce_uniform,
+            max_length=19)
+
+        # Only 1 in 2 ** 20 sentences fits
+        self.assertRaises(ValueError, compiled.produce_uniform,
+            max_length=20)
+
+    def test_lengths(self):
+        grammar = nltk.parse_cfg(b'''
+S -> greeting ' ' name __CONTINUE50__ '!'
+S -> 'hello ' S
+greeting -> 'hello'
+greeting -> 'hi'
+name -> 'kitten'
+name -> 'puppy'
+''')
+        compiled = CompiledGrammar(grammar)
+        compiled.compute_lengths()
+
+        self.assertEqual(compiled.min_lengths[compiled.get_id('greeting')], 2)
+        self.assertEqual(compiled.max_lengths[compiled.get_id('greeting')], 5)
+        self.assertEqual(compiled.min_lengths[compiled.start], 8)
+        self.assertEqual(compiled.max_lengths[compiled.start], float('inf'))
+
+        for dummy in range(100):
+            self.assertLessEqual(len(compiled.produce(max_length=11)), 11)
+
+        self.assertEqual(compiled.produce(max_length=8), u'hi puppy')
+        self.assertRaises(ValueError, compiled.produce, max_length=7)
+
+    @unittest.skipIf(not numpy, 'NumPy is not installed')
+    def test_produce_batch(self):
+        grammar = nltk.parse_cfg(TEST_GRAMMAR)
+        compiled = CompiledGrammar(grammar)
+        facts = compiled.produce_batch(200,
+            random_state=numpy.random.RandomState(1))
+
+        self.assertEqual(len(facts), 200)
+        self.assertEqual(set(facts), set([
+            u'hello kitten', u'hello kitten!', u'hello puppy',
+            u'hello puppy!', u'hi kitten', u'hi kitten!', u'hi puppy',
+            u'hi puppy!',
+        ]))
+        self.assertEqual(facts, compiled.produce_batch(200,
+            random_state=numpy.random.RandomState(1)))
+
+        numpy.random.seed(2)
+        facts = compiled.produce_batch(200)
+        numpy.random.seed(2)
+
+        self.assertEqual(facts, compiled.produce_batch(200))
+
+    def test_replay(self):
+        grammar = nltk.parse_cfg(TEST_GRAMMAR)
+        compiled = CompiledGrammar(grammar)
+        compiled.compute_lengths()
+
+        for max_length in (None, 11):
+            for dummy in range(50):
+                choices = []
+                sentence = compiled.produce(max_length=max_length,
+                    choices=choices)
+
+                self.assertEqual(compiled.replay(choices), sentence)
+
+        self.assertEqual(compiled.replay([0, 1, 0, 1]), u'hi kitten!')
+        self.assertRaises(ValueError, compiled.replay, [0, 1, 0])
+        self.assertRaises(ValueError, compiled.replay, [0, 1, 0, 1, 1])
+        self.assertRaises(ValueError, compiled.replay, [0, 5, 0, 1])
+
+    def test_varints(self):
+        values = [0, 1, 127, 128, 300, 2 ** 40]
+        data = encode_varints(values)
+
+        self.assertEqual(len(data), 1 + 1 + 1 + 2 + 2 + 6)
+        self.assertEqual(decode_varints(data), values)
+        self.assertEqual(encode_varints([300]), b'\xac\x02')
+        self.assertRaises(ValueError, decode_varints, b'\x80')
+
+    def test_parse_continue_symbol(self):
+        self.assertAlmostEqual(parse_continue_symbol('__CONTINUE09__'), 0.09)
+        self.assertAlmostEqual(parse_continue_symbol('__CONTINUE42__'), 0.42)
+
+
+class TestFactBuilder(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_fact(self):
+        random.seed(1)
+        fact_builder = FactBuilder()
+
+        for dummy in range(100):
+            fact = fact_builder.fact()
+            self.assertIsInstance(fact, unicode)
+            self.assertTrue(fact)
+            self.assertNotIn(u'__ERROR__', fact)
+
+    def test_facts(self):
+        fact_builder = FactBuilder()
+        facts = fact_builder.facts(100)
+
+        self.assertEqual(len(facts), 100)
+
+        for fact in facts:
+            self.assertIsInstance(fact, unicode)
+            self.assertTrue(fact)
+            self.assertNotIn(u'__ERROR__', fact)
+
+    def test_fact_max_length(self):
+        fact_builder = FactBuilder()
+
+        for dummy in range(100):
+            self.assertLessEqual(len(fact_builder.fact(max_length=80)), 80)
+
+    def test_fact_symbol(self):
+        fact_builder = FactBuilder()
+
+        for symbol in FACT_SYMBOLS:
+            fact = fact_builder.fact(max_length=100, symbol=symbol)
+
+            self.assertTrue(fact)
+            self.assertLessEqual(len(fact), 100)
+            self.assertTrue(fact_builder.fact(uniform=True, symbol=symbol))
+
+    def test_fact_with_derivation(self):
+        fact_builder = FactBuilder()
+        derivations = []
+
+        for max_length in (None, 80):
+            for symbol in (None,) + FACT_SYMBOLS:
+                fact, derivation = fact_builder.fact_with_derivation(
+                    max_length=max_length, symbol=symbol)
+
+                self.assertEqual(derivation.grammar_version,
+                    fact_builder.grammar_version)
+                self.assertEqual(fact_builder.decode_derivation(derivation),
+                    fact)
+                derivations.append(derivation)
+
+        self.assertRaises(ValueError, fact_builder.decode_derivation,
+            Derivation('other', derivations[0].data))
+
+        counts = fact_builder.count_choices(derivations)
+        protip_count = sum(count for (symbol, index), count
+            in counts.items() if symbol == 'protip')
+
+        self.assertGreaterEqual(protip_count, 2)
+        self.assertFalse(fact_builder.count_choices(
+            [Derivation('other', derivations[0].data)]))
+
+    def test_fact_uniform(self):
+        fact_builder = FactBuilder()
+
+        for dummy in range(20):
+            self.assertLessEqual(
+                len(fact_builder.fact(max_length=100, uniform=True)), 100)
+
+        self.assertEqual(len(fact_builder.facts(5, seed=1, uniform=True)), 5)
+
+    def test_generate_facts(self):
+        fact_builder = FactBuilder()
+        facts = list(generate_facts(fact_builder, 50, 42, chunk_size=20))
+
+        self.assertEqual(len(facts), 50)
+        self.assertEqual(facts, fact_builder.facts(20, seed=(42, 0))
+            + fact_builder.facts(20, seed=(42, 1))
+            + fact_builder.facts(10, seed=(42, 2)))
+        self.assertEqual(facts, list(generate_facts(fact_builder, 50, 42,
+            workers=2, chunk_size=20)))
+
+    def test_cache(self):
+        cache_path = os.path.join(self.temp_dir, 'grammar.cache')
+        fact_builder = FactBuilder(cache_path=cache_path)
+
+        self.assertTrue(os.path.exists(cache_path))
+
+        cached_fact_builder = FactBuilder(cache_path=cache_path)
+
+        self.assertEqual(cached_fact_builder.grammar_version,
+            fact_builder.grammar_version)
+        self.assertTrue(cached_fact_builder.fact())
+
+    def test_stale_cache(self):
+        cache_path = os.path.join(self.temp_dir, 'grammar.cache')
+
+        with open(cache_path, 'wb') as file:
+            file.write(b'garbage')
+
+        fact_builder = FactBuilder(cache_path=cache_path)
+
+        self.assertTrue(fact_builder.fact())
+        self.assertNotEqual(open(cache_path, 'rb').read(), b'garbage')
+
+
+class TestReload(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.original_get_corpus_data_dir = corpus.get_corpus_data_dir
+        corpus.get_corpus_data_dir = lambda: self.temp_dir
+
+        os.mkdir(os.path.join(self.temp_dir, 'things'))
+        self.write('compfacts.grammar_text', b"S -> 'a ' color ' ' animal")
+        self.write('things/animal.corpus_text', b'cat\ndog')
+        self.write('things/color.corpus_text', b'red')
+
+    def tearDown(self):
+        corpus.get_corpus_data_dir = self.original_get_corpus_data_dir
+        shutil.rmtree(self.temp_dir)
+
+    def write(self, filename, text):
+        path = os.path.join(self.temp_dir, filename)
+        temp_path = path + '.tmp'
+
+        # Replace the file like an editor so memory maps stay valid
+        with open(temp_path, 'wb') as file:
+            file.write(text)
+
+        os.rename(temp_path, path)
+
+    def get_facts(self, fact_builder):
+        return set(fact_builder.fact() for dummy in range(100))
+
+    def test_reload(self):
+        fact_builder = FactBuilder()
+        version = fact_builder.grammar_version
+        color_index = fact_builder._compiled_grammar.get_corpus('color')
+
+        self.assertFalse(fact_builder.reload())
+        self.assertEqual(self.get_facts(fact_builder),
+            set([u'a RED CAT', u'a RED DOG']))
+
+        self.write('things/animal.corpus_text', b'cat\nemu')
+
+        self.assertTrue(fact_builder.reload())
+        self.assertNotEqual(fact_builder.grammar_version, version)
+        self.assertEqual(self.get_facts(fact_builder),
+            set([u'a RED CAT', u'a RED EMU']))
+        self.assertIs(fact_builder._compiled_grammar.get_corpus('color'),
+            color_index)
+        self.assertFalse(fact_builder.reload())
+
+        self.write('things/extra.grammar_text', b"S -> 'no ' color")
+
+        self.assertTrue(fact_builder.reload())
+        self.assertIn(u'no RED', self.get_facts(fact_builder))
+        self.assertIs(fact_builder._compiled_grammar.get_corpus('color'),
+            color_index)
+
+    def test_reload_error(self):
+        fact_builder = FactBuilder()
+        version = fact_builder.grammar_version
+
+        self.write('things/extra.grammar_text', b"S -> 'a ' missing")
+
+        self.assertFalse(fact_builder.reload())
+        self.assertEqual(fact_builder.grammar_version, version)
+        self.assertEqual(self.get_facts(fact_builder),
+            set([u'a RED CAT', u'a RED DOG']))
+        self.assertFalse(fact_builder.reload())
+
+        self.write('things/missing.corpus_text', b'fish')
+
+        self.assertTrue(fact_builder.reload())
+        self.assertIn(u'a FISH', self.get_facts(fact_builder))
+
+        os.remove(os.path.join(self.temp_dir, 'things/missing.corpus_text'))
+
+        self.assertFalse(fact_builder.reload())
+        self.assertIn(u'a FISH', self.get_facts(fact_builder))
+
+        self.write('things/extra.grammar_text', b"S -> 'a ' 'bad")
+
+        self.assertFalse(fact_builder.reload())
+
+        self.write('things/extra.grammar_text', b'')
+
+        self.assertTrue(fact_builder.reload())
+        self.assertEqual(self.get_facts(fact_builder),
+            set([u'a RED CAT', u'a RED DOG']))
+
+    def test_count_choices_after_reload(self):
+        fact_builder = FactBuilder()
+        derivations = [fact_builder.fact_with_derivation()[1]
+            for dummy in range(10)]
+        version = fact_builder.grammar_version
+
+        self.write('things/animal.corpus_text', b'emu')
+
+        self.assertTrue(fact_builder.reload())
+        self.assertEqual(get_structure_version(fact_builder.grammar_version),
+            get_structure_version(version))
+        self.assertRaises(ValueError, fact_builder.decode_derivation,
+            derivations[0])
+
+        derivations.append(fact_builder.fact_with_derivation()[1])
+        counts = fact_builder.count_choices(derivations)
+
+        self.assertEqual(counts[('S', 0)], 11)
+        self.assertEqual(counts[('animal', None)], 11)
+
+        self.write('things/extra.grammar_text', b"S -> 'no ' color")
+
+        self.assertTrue(fact_builder.reload())
+        self.assertFalse(fact_builder.count_choices(derivations))
+
+    def test_replace_in_use(self):
+        fact_builder = FactBuilder()
+        animal_index = fact_builder._compiled_grammar.get_corpus('animal')
+        state = cPickle.dumps(animal_index)
+
+        self.write('things/animal.corpus_text', b'ox')
+
+        self.assertEqual(self.get_facts(fact_builder),
+            set([u'a RED CAT', u'a RED DOG']))
+        self.assertRaises(ValueError, cPickle.loads, state)
+        self.assertTrue(fact_builder.reload())
+        self.assertEqual(self.get_facts(fact_builder), set([u'a RED OX']))
+
+    def test_reloader(self):
+        fact_builder = FactBuilder()
+        version = fact_builder.grammar_version
+        reloader = GrammarReloader(fact_builder, interval=0.01)
+        reloader.start()
+
+        self.write('things/color.corpus_text', b'blue')
+
+        deadline = time.time() + 5
+
+        while fact_builder.grammar_version == version \
+        and time.time() < deadline:
+            time.sleep(0.01)
+
+        reloader.stop()
+        reloader.join()
+
+        self.assertIn(u'a BLUE CAT', self.get_facts(fact_builder))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,255 @@
+# encoding=utf8
+'''In-process metrics'''
+# Copyright 2014 by Christopher Foo <chris.foo@gmail.com>
+# Licensed under GPLv3. See COPYING.txt for details.
+from __future__ import (print_function, absolute_import, unicode_literals,
+    with_statement)
+import bisect
+import contextlib
+import os
+import os.path
+import tempfile
+import threading
+import time
+
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+    10.0)
+'''Default histogram bucket upper bounds in seconds.'''
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+'''Content type of the Prometheus text format.'''
+
+
+class Metric(object):
+    '''Base class for metrics.
+
+    Args:
+        name (str): The metric name.
+        help_text (str): The description of the metric.
+        labels (dict): Label names and values.
+    '''
+
+    type_name = None
+
+    def __init__(self, name, help_text, labels=None):
+        self.name = name
+        self.help_text = help_text
+        self.labels = tuple(sorted((labels or {}).items()))
+        self._lock = threading.Lock()
+
+    def samples(self):
+        '''Return a list of tuples of sample name suffix, extra labels and
+        value.'''
+
+        raise NotImplementedError()
+
+
+class Counter(Metric):
+    '''A value that only increases.'''
+
+    type_name = 'counter'
+
+    def __init__(self, *args, **kwargs):
+        Metric.__init__(self, *args, **kwargs)
+        self.value = 0
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def samples(self):
+        return [('', (), self.value)]
+
+
+class Gauge(Metric):
+    '''A value that may go up or down.'''
+
+    type_name = 'gauge'
+
+    def __init__(self, *args, **kwargs):
+        Metric.__init__(self, *args, **kwargs)
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def samples(self):
+        return [('', (), self.value)]
+
+
+class Histogram(Metric):
+    '''Counts of observed values in buckets.
+
+    Args:
+        buckets (tuple): Sorted bucket upper bounds.
+    '''
+
+    type_name = 'histogram'
+
+    def __init__(self, name, help_text, labels=None,
+    buckets=DEFAULT_BUCKETS):
+        Metric.__init__(self, name, help_text, labels)
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    @contextlib.contextmanager
+    def time(self):
+        '''Observe the number of seconds the block takes.'''
+
+        start_time = time.time()
+
+        try:
+            yield
+        finally:
+            self.observe(time.time() - start_time)
+
+    def samples(self):
+        with self._lock:
+            counts = list(self.counts)
+            total = self.sum
+            count = self.count
+
+        samples = []
+        cumulative_count = 0
+
+        for bound, bucket_count in zip(self.buckets + (float('inf'),),
+        counts):
+            cumulative_count += bucket_count
+            samples.append(('_bucket', (('le', format_value(bound)),),
+                cumulative_count))
+
+        samples.append(('_sum', (), total))
+        samples.append(('_count', (), count))
+
+        return samples
+
+
+class Registry(object):
+    '''A collection of metrics.
+
+    Metrics with the same name and different labels are grouped together.
+    '''
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _get_metric(self, metric_class, name, help_text, labels, **kwargs):
+        key = (name, tuple(sorted((labels or {}).items())))
+
+        with self._lock:
+            metric = self._metrics.get(key)
+
+            if not metric:
+                metric = self._metrics[key] = metric_class(name, help_text,
+                    labels, **kwargs)
+            elif not isinstance(metric, metric_class):
+                raise ValueError('Metric {0} is a {1}'.format(
+                    name, metric.type_name))
+
+        return metric
+
+    def counter(self, name, help_text, labels=None):
+        '''Return the counter, creating it if needed.'''
+
+        return self._get_metric(Counter, name, help_text, labels)
+
+    def gauge(self, name, help_text, labels=None):
+        '''Return the gauge, creating it if needed.'''
+
+        return self._get_metric(Gauge, name, help_text, labels)
+
+    def histogram(self, name, help_text, labels=None,
+    buckets=DEFAULT_BUCKETS):
+        '''Return the histogram, creating it if needed.'''
+
+        return self._get_metric(Histogram, name, help_text, labels,
+            buckets=buckets)
+
+    def format_text(self):
+        '''Return the metrics in the Prometheus text format.'''
+
+        with self._lock:
+            metrics = sorted(self._metrics.values(),
+                key=lambda metric: (metric.name, metric.labels))
+
+        lines = []
+        previous_name = None
+
+        for metric in metrics:
+            if metric.name != previous_name:
+                previous_name = metric.name
+                lines.append('# HELP {0} {1}'.format(metric.name,
+                    metric.help_text.replace('\\', '\\\\').replace(
+                        '\n', '\\n')))
+                lines.append('# TYPE {0} {1}'.format(metric.name,
+                    metric.type_name))
+
+            for suffix, extra_labels, value in metric.samples():
+                lines.append('{0}{1}{2} {3}'.format(metric.name, suffix,
+                    format_labels(metric.labels + extra_labels),
+                    format_value(value)))
+
+        lines.append('')
+
+        return '\n'.join(lines)
+
+    def dump(self, path):
+        '''Write the metrics to the file atomically.'''
+
+        dir_path = os.path.dirname(os.path.abspath(path))
+        fd, temp_path = tempfile.mkstemp(dir=dir_path, prefix='.tmp-',
+            suffix='.prom')
+
+        try:
+            with os.fdopen(fd, 'wb') as file:
+                file.write(self.format_text().encode('utf8'))
+
+            os.rename(temp_path, path)
+        except (IOError, OSError):
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+            raise
+
+
+def format_labels(labels):
+    '''Format the label pairs as ``{name="value",...}``.'''
+
+    if not labels:
+        return ''
+
+    return '{{{0}}}'.format(','.join(
+        '{0}="{1}"'.format(name, unicode(value).replace('\\', '\\\\')
+            .replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in labels))
+
+
+def format_value(value):
+    '''Format the number as a Prometheus sample value.'''
+
+    if isinstance(value, (int, long)):
+        return unicode(value)
+    elif value == float('inf'):
+        return '+Inf'
+    elif value == float('-inf'):
+        return '-Inf'
+    elif value != value:
+        return 'NaN'
+    else:
+        return repr(float(value))
+
+
+REGISTRY = Registry()
+'''The default registry.'''
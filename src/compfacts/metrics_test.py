@@ -0,0 +1,65 @@
+# encoding=utf-8
+
+from compfacts.metrics import Registry
+import os.path
+import shutil
+import tempfile
+import unittest
+
+
+class TestRegistry(unittest.TestCase):
+    def test_counter(self):
+        registry = Registry()
+        counter = registry.counter('requests_total', 'Requests',
+            labels={'path': '/a"b'})
+        counter.inc()
+        counter.inc(2)
+
+        self.assertIs(registry.counter('requests_total', 'Requests',
+            labels={'path': '/a"b'}), counter)
+        self.assertEqual(registry.format_text(),
+            '# HELP requests_total Requests\n'
+            '# TYPE requests_total counter\n'
+            'requests_total{path="/a\\"b"} 3\n')
+        self.assertRaises(ValueError, registry.gauge, 'requests_total',
+            'Requests', labels={'path': '/a"b'})
+
+    def test_histogram(self):
+        registry = Registry()
+        histogram = registry.histogram('duration_seconds', 'Duration',
+            buckets=(0.1, 1.0))
+        histogram.observe(0.05)
+        histogram.observe(0.1)
+        histogram.observe(5)
+
+        with histogram.time():
+            pass
+
+        self.assertEqual(registry.format_text(),
+            '# HELP duration_seconds Duration\n'
+            '# TYPE duration_seconds histogram\n'
+            'duration_seconds_bucket{le="0.1"} 3\n'
+            'duration_seconds_bucket{le="1.0"} 3\n'
+            'duration_seconds_bucket{le="+Inf"} 4\n'
+            'duration_seconds_sum %r\n'
+            'duration_seconds_count 4\n' % histogram.sum)
+
+    def test_dump(self):
+        temp_dir = tempfile.mkdtemp()
+
+        try:
+            registry = Registry()
+            registry.gauge('fail_count', 'Failures').set(2)
+            path = os.path.join(temp_dir, 'compfacts.prom')
+            registry.dump(path)
+
+            with open(path, 'rb') as file:
+                self.assertIn(b'fail_count 2\n', file.read())
+
+            self.assertEqual(os.listdir(temp_dir), ['compfacts.prom'])
+        finally:
+            shutil.rmtree(temp_dir)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -2,12 +2,19 @@
 '''Post facts'''
 # Copyright 2012-2014 by Christopher Foo <chris.foo@gmail.com>
 # Licensed under GPLv3. See COPYING.txt for details.
+from compfacts import metrics
+from compfacts.grammar import Derivation
+import collections
 import contextlib
+import functools
+import hashlib
 import logging
+import math
 import random
 import re
 import sched
 import sqlite3
+import struct
 import threading
 import time
 import tweepy
@@ -15,35 +22,167 @@ import tweepy
 
 _logger = logging.getLogger(__name__)
 
+MAX_FACT_LENGTH = 120
+'''Maximum length of an escaped fact posted.'''
+
+DEFAULT_PAGE_SIZE = 100
+'''Default number of facts returned by :meth:`Database.get_facts`.'''
+
+_duplicate_regenerations_total = metrics.REGISTRY.counter(
+    'compfacts_fact_regenerations_total',
+    'Facts rejected and generated again by the post scheduler',
+    labels={'reason': 'duplicate'})
+_length_regenerations_total = metrics.REGISTRY.counter(
+    'compfacts_fact_regenerations_total',
+    'Facts rejected and generated again by the post scheduler',
+    labels={'reason': 'length'})
+_post_seconds = metrics.REGISTRY.histogram('compfacts_post_seconds',
+    'Time taken by posting a message to the API service')
+_posts_total = metrics.REGISTRY.counter('compfacts_posts_total',
+    'Facts posted')
+_post_failures_total = metrics.REGISTRY.counter(
+    'compfacts_post_failures_total', 'Failed attempts to post a fact')
+
+
+def _timed_query(func):
+    '''Record the time taken by the database method.'''
+
+    histogram = metrics.REGISTRY.histogram(
+        'compfacts_database_query_seconds', 'Time taken by database queries',
+        labels={'query': func.__name__})
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with histogram.time():
+            return func(*args, **kwargs)
+
+    return wrapper
+
 
 class Database(object):
+    '''The fact database.
+
+    Each thread gets its own long-lived connection which is opened and
+    configured on first use. Call :meth:`close` to close all of them.
+    '''
+
     def __init__(self, path):
         super(object)
 
         self._path = path
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
 
         self.create_fact_table()
 
-    @contextlib.contextmanager
-    def connection(self):
+    def _connect(self):
+        # Connections are only used by the thread that opened them but may
+        # be closed by any thread in close()
         con = sqlite3.connect(self._path, isolation_level='DEFERRED',
-            detect_types=sqlite3.PARSE_DECLTYPES)
+            detect_types=sqlite3.PARSE_DECLTYPES, check_same_thread=False)
 
         con.row_factory = sqlite3.Row
         con.execute('PRAGMA synchronous=NORMAL')
         con.execute('PRAGMA journal_mode=WAL')
         con.execute('PRAGMA foreign_keys=ON')
 
+        with self._connections_lock:
+            self._connections.append(con)
+
+        return con
+
+    @contextlib.contextmanager
+    def connection(self):
+        local = self._local
+        con = getattr(local, 'connection', None)
+
+        if con is None:
+            con = local.connection = self._connect()
+
         with con:
             yield con
 
+    def close(self):
+        '''Close the connections of all threads.
+
+        The database can still be used afterwards; connections are reopened
+        as needed.
+        '''
+
+        with self._connections_lock:
+            connections = self._connections
+            self._connections = []
+            self._local = threading.local()
+
+        for con in connections:
+            con.close()
+
     def create_fact_table(self):
         with self.connection() as con:
             con.execute('CREATE TABLE IF NOT EXISTS '
                 'facts (id INTEGER PRIMARY KEY AUTOINCREMENT,'
                 "timestamp INTEGER NOT NULL DEFAULT (strftime('%s', 'now')),"
-                'fact TEXT NOT NULL)')
+                'fact TEXT NOT NULL,'
+                'fact_hash INTEGER,'
+                'derivation BLOB,'
+                'grammar_version TEXT)')
+
+            columns = [row[1] for row in con.execute(
+                'PRAGMA table_info(facts)')]
+
+            if 'fact_hash' not in columns:
+                self._add_fact_hash_column(con)
+
+            if 'derivation' not in columns:
+                self._add_derivation_columns(con, 'facts')
+
+            con.execute('CREATE UNIQUE INDEX IF NOT EXISTS '
+                'facts_fact_hash ON facts (fact_hash)')
+            con.execute('CREATE INDEX IF NOT EXISTS '
+                'facts_timestamp_id ON facts (timestamp, id)')
+            con.execute('CREATE TABLE IF NOT EXISTS '
+                'queued_facts (id INTEGER PRIMARY KEY AUTOINCREMENT,'
+                'fact TEXT NOT NULL,'
+                'escaped_fact TEXT NOT NULL,'
+                'derivation BLOB,'
+                'grammar_version TEXT)')
+
+            columns = [row[1] for row in con.execute(
+                'PRAGMA table_info(queued_facts)')]
+
+            if 'derivation' not in columns:
+                self._add_derivation_columns(con, 'queued_facts')
 
+    def _add_fact_hash_column(self, con):
+        _logger.info('Adding fact hash column')
+
+        con.execute('ALTER TABLE facts ADD COLUMN fact_hash INTEGER')
+
+        seen_hashes = set()
+        updates = []
+
+        for row in con.execute('SELECT id, fact FROM facts ORDER BY id'):
+            hash_value = fact_hash(row[1])
+
+            # Facts posted more than once keep a null hash after the first
+            if hash_value not in seen_hashes:
+                seen_hashes.add(hash_value)
+                updates.append((hash_value, row[0]))
+
+        con.executemany('UPDATE facts SET fact_hash = ? WHERE id = ?',
+            updates)
+
+    def _add_derivation_columns(self, con, table):
+        _logger.info('Adding derivation columns to %s', table)
+
+        # Existing facts have no derivation and keep only their text
+        con.execute('ALTER TABLE {0} ADD COLUMN derivation BLOB'
+            .format(table))
+        con.execute('ALTER TABLE {0} ADD COLUMN grammar_version TEXT'
+            .format(table))
+
+    @_timed_query
     def get_last_timestamp(self):
         with self.connection() as con:
             cursor = con.execute('SELECT MAX(timestamp) FROM facts LIMIT 1')
@@ -55,20 +194,155 @@ class Database(object):
         else:
             return 0
 
-    def insert_fact(self, fact):
+    def get_data_version(self):
+        '''Return a number that changes when another connection commits
+        to the database.
+
+        The number is only comparable to ones returned to the same thread.
+        '''
+
+        with self.connection() as con:
+            return con.execute('PRAGMA data_version').fetchone()[0]
+
+    @_timed_query
+    def insert_fact(self, fact, derivation=None):
+        '''Insert a posted fact.
+
+        Args:
+            fact (unicode): The fact text.
+            derivation (Derivation): If given, the choices that generated
+                the fact.
+        '''
+
+        derivation_values = _derivation_values(derivation)
+
+        with self.connection() as con:
+            try:
+                con.execute('INSERT INTO facts (fact, fact_hash, derivation, '
+                    'grammar_version) VALUES (?, ?, ?, ?)',
+                    [fact, fact_hash(fact)] + derivation_values)
+            except sqlite3.IntegrityError:
+                _logger.warning('Fact already exists: %s', fact)
+                con.execute('INSERT INTO facts (fact, derivation, '
+                    'grammar_version) VALUES (?, ?, ?)',
+                    [fact] + derivation_values)
+
+    @_timed_query
+    def get_last_fact_id(self):
+        with self.connection() as con:
+            row = con.execute('SELECT id FROM facts ORDER BY id DESC LIMIT 1'
+                ).fetchone()
+
+            if row:
+                return row[0]
+
+    @_timed_query
+    def insert_queued_fact(self, fact, escaped_fact, derivation=None):
+        '''Store a fact waiting to be posted and return its ID.'''
+
+        with self.connection() as con:
+            cursor = con.execute('INSERT INTO queued_facts '
+                '(fact, escaped_fact, derivation, grammar_version) '
+                'VALUES (?, ?, ?, ?)',
+                [fact, escaped_fact] + _derivation_values(derivation))
+
+            return cursor.lastrowid
+
+    @_timed_query
+    def delete_queued_fact(self, queued_fact_id):
+        with self.connection() as con:
+            con.execute('DELETE FROM queued_facts WHERE id = ?',
+                [queued_fact_id])
+
+    def get_queued_facts(self):
+        '''Return tuples of ID, fact, escaped fact and :class:`Derivation`
+        or None, oldest first.'''
+
+        with self.connection() as con:
+            cursor = con.execute('SELECT id, fact, escaped_fact, '
+                'grammar_version, derivation FROM queued_facts ORDER BY id')
+
+            return [(row[0], row[1], row[2], _row_derivation(row[3], row[4]))
+                for row in cursor]
+
+    @_timed_query
+    def get_derivations(self, grammar_version=None, structure_version=None):
+        '''Return the :class:`Derivation` of each posted fact that has one.
+
+        Args:
+            grammar_version (str): If given, only derivations of the
+                version are returned.
+            structure_version (str): If given, only derivations of
+                versions with the structure version are returned. See
+                :func:`.grammar.get_grammar_version`.
+        '''
+
+        with self.connection() as con:
+            if grammar_version is not None:
+                cursor = con.execute('SELECT grammar_version, derivation '
+                    'FROM facts WHERE grammar_version = ? '
+                    'AND derivation IS NOT NULL ORDER BY id',
+                    [grammar_version])
+            elif structure_version is not None:
+                prefix = structure_version + u'-'
+                cursor = con.execute('SELECT grammar_version, derivation '
+                    'FROM facts WHERE substr(grammar_version, 1, ?) = ? '
+                    'AND derivation IS NOT NULL ORDER BY id',
+                    [len(prefix), prefix])
+            else:
+                cursor = con.execute('SELECT grammar_version, derivation '
+                    'FROM facts WHERE derivation IS NOT NULL ORDER BY id')
+
+            return [_row_derivation(row[0], row[1]) for row in cursor]
+
+    @_timed_query
+    def has_fact_hash(self, hash_value):
         with self.connection() as con:
-            con.execute('INSERT INTO facts (fact) VALUES (?)', [fact])
+            cursor = con.execute('SELECT 1 FROM facts WHERE fact_hash = ? '
+                'LIMIT 1', [hash_value])
+
+            return cursor.fetchone() is not None
+
+    def get_fact_hashes(self):
+        with self.connection() as con:
+            cursor = con.execute('SELECT fact_hash FROM facts '
+                'WHERE fact_hash IS NOT NULL')
+
+            return [row[0] for row in cursor]
+
+    @_timed_query
+    def get_facts(self, after_timestamp=None, before_id=None,
+    limit=DEFAULT_PAGE_SIZE):
+        '''Return a page of facts, newest first.
+
+        Args:
+            after_timestamp (int): Only include facts posted at or before
+                this time. Defaults to now.
+            before_id (int): If given, only include facts at
+                `after_timestamp` with a lower ID. Pass the timestamp and ID
+                of the last fact of a page to get the next page.
+            limit (int): The maximum number of facts.
+
+        Returns:
+            list: Tuples of timestamp, fact and ID.
+        '''
 
-    def get_facts(self, after_timestamp=None):
         facts = []
 
         if not after_timestamp:
             after_timestamp = time.time()
 
         with self.connection() as con:
-            cursor = con.execute('SELECT id, timestamp, fact FROM facts '
-                'WHERE timestamp <= ? '
-                'ORDER BY id DESC LIMIT 100', [after_timestamp])
+            if before_id is None:
+                cursor = con.execute('SELECT id, timestamp, fact FROM facts '
+                    'WHERE timestamp <= ? '
+                    'ORDER BY timestamp DESC, id DESC LIMIT ?',
+                    [after_timestamp, limit])
+            else:
+                cursor = con.execute('SELECT id, timestamp, fact FROM facts '
+                    'WHERE timestamp <= ? AND (timestamp < ? OR id < ?) '
+                    'ORDER BY timestamp DESC, id DESC LIMIT ?',
+                    [after_timestamp, after_timestamp, before_id, limit])
 
             for row in cursor:
                 facts.append((row[1], row[2], row[0]))
@@ -76,101 +350,471 @@ class Database(object):
         return facts
 
 
-class PostScheduler(threading.Thread):
+def _derivation_values(derivation):
+    if derivation is None:
+        return [None, None]
+
+    return [sqlite3.Binary(derivation.data), derivation.grammar_version]
+
+
+def _row_derivation(grammar_version, data):
+    if data is None:
+        return None
+
+    return Derivation(grammar_version, bytes(data))
+
+
+class BloomFilter(object):
+    '''A Bloom filter of 64-bit integer hashes.
+
+    Args:
+        capacity (int): The expected number of items.
+        error_rate (float): The false positive rate at capacity.
+    '''
+
+    def __init__(self, capacity, error_rate=0.001):
+        capacity = max(1, capacity)
+        self._num_bits = int(math.ceil(
+            -capacity * math.log(error_rate) / math.log(2) ** 2))
+        self._num_hashes = max(1, int(round(
+            self._num_bits / float(capacity) * math.log(2))))
+        self._bits = bytearray((self._num_bits + 7) // 8)
+
+    def _positions(self, hash_value):
+        hash_value &= 0xffffffffffffffff
+        hash_1 = hash_value & 0xffffffff
+        hash_2 = (hash_value >> 32) | 1
+
+        for index in xrange(self._num_hashes):
+            yield (hash_1 + index * hash_2) % self._num_bits
+
+    def add(self, hash_value):
+        for position in self._positions(hash_value):
+            self._bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, hash_value):
+        for position in self._positions(hash_value):
+            if not self._bits[position >> 3] & (1 << (position & 7)):
+                return False
+
+        return True
+
+
+class DuplicateFilter(object):
+    '''Tells whether a fact is in the database.
+
+    A Bloom filter warmed from the database rejects most new facts without
+    a query. Possible duplicates are confirmed using the fact hash index.
+    '''
+
+    def __init__(self, database, capacity=100000, error_rate=0.001):
+        self._database = database
+        hashes = database.get_fact_hashes()
+        self._bloom_filter = BloomFilter(max(capacity, len(hashes) * 2),
+            error_rate)
+
+        for hash_value in hashes:
+            self._bloom_filter.add(hash_value)
+
+        _logger.debug('Duplicate filter warmed with %s facts', len(hashes))
+
+    def add(self, fact):
+        self._bloom_filter.add(fact_hash(fact))
+
+    def __contains__(self, fact):
+        hash_value = fact_hash(fact)
+
+        if hash_value not in self._bloom_filter:
+            return False
+
+        return self._database.has_fact_hash(hash_value)
+
+
+class FactQueue(object):
+    '''A bounded queue of facts ready to be posted.
+
+    The queue has no thread of its own. The owner calls :meth:`fill`
+    while it is idle so facts do not need to be generated when they are
+    posted.
+
+    Args:
+        new_fact: A function that returns a tuple of fact text, escaped
+            fact text and :class:`Derivation` or None.
+        size (int): The maximum number of queued facts.
+        database (Database): If given, queued facts are stored in the
+            database and restored when the queue is created again.
+    '''
+
+    def __init__(self, new_fact, size, database=None):
+        self._new_fact = new_fact
+        self._size = size
+        self._queue = collections.deque()
+        self._database = database
+        self._queued_texts = set()
+
+        if database:
+            self._restore()
+
+    def _restore(self):
+        for row in self._database.get_queued_facts():
+            queued_fact_id = row[0]
+            fact_text = row[1]
+
+            if not self.full() and fact_text not in self._queued_texts:
+                self._queued_texts.add(fact_text)
+                self._queue.append((queued_fact_id, row[1:]))
+            else:
+                self._database.delete_queued_fact(queued_fact_id)
+
+        _logger.debug('Restored %s queued facts', len(self._queued_texts))
+
+    def full(self):
+        return len(self._queue) >= self._size
+
+    def fill(self):
+        '''Generate and queue one fact unless the queue is full.
+
+        Returns:
+            bool: True if the queue is still not full.
+        '''
+
+        if self.full():
+            return False
+
+        fact = self._new_fact()
+        fact_text = fact[0]
+
+        if fact_text in self._queued_texts:
+            return True
+
+        if self._database:
+            queued_fact_id = self._database.insert_queued_fact(*fact)
+        else:
+            queued_fact_id = None
+
+        self._queued_texts.add(fact_text)
+        self._queue.append((queued_fact_id, fact))
+
+        return not self.full()
+
+    def __contains__(self, fact_text):
+        return fact_text in self._queued_texts
+
+    def __len__(self):
+        return len(self._queue)
+
+    def get(self):
+        '''Remove and return the oldest fact.
+
+        A new fact is generated if the queue is empty.
+
+        Returns:
+            tuple: The fact text, escaped fact text and derivation.
+        '''
+
+        if not self._queue:
+            return self._new_fact()
+
+        queued_fact_id, fact = self._queue.popleft()
+        self._queued_texts.discard(fact[0])
+
+        if queued_fact_id is not None:
+            self._database.delete_queued_fact(queued_fact_id)
+
+        return fact
+
+
+class PostAccount(object):
+    '''Posts facts for one account at random intervals.
+
+    The account does not have a thread of its own. Its posts are events of
+    the scheduler given to :meth:`start`, which may be shared with other
+    accounts.
+
+    Args:
+        fact_builder (FactBuilder): The fact builder, which may be shared.
+        database (Database): The database of the account's posts.
+        api_service: The sink posts are sent to.
+        interval (float): The average number of seconds between posts.
+        deviation (float): The maximum number of seconds a post is early or
+            late.
+        retry_delay (float): The number of seconds before retrying a failed
+            post. It is multiplied by the number of failures in a row.
+        prefetch (int): If given, the number of facts generated ahead of
+            time by a :class:`FactQueue`. It is filled by events of the
+            scheduler that run only when no post is due.
+        persist_prefetch (bool): If True, the queued facts are stored in
+            the database.
+        name (str): The name of the account in logs and metrics.
+    '''
+
     def __init__(self, fact_builder, database, api_service, interval=3600 * 6,
-    deviation=3600 * 2, retry_delay=30):
-        threading.Thread.__init__(self)
-        self.daemon = True
+    deviation=3600 * 2, retry_delay=30, prefetch=0, persist_prefetch=False,
+    name='default'):
+        self.name = name
+        self.database = database
         self._interval = interval
         self._deviation = deviation
         self._retry_delay = retry_delay
         self._database = database
         self._fact_builder = fact_builder
         self._api_service = api_service
-        self._scheduler = sched.scheduler(time.time, time.sleep)
+        self._scheduler = None
         self._running = False
         self._fail_count = 0
+        self._prefetch_fail_count = 0
+        self._duplicate_filter = DuplicateFilter(database)
+        self._last_post_timestamp = None
+        self._next_post_timestamp = None
+        self._data_version = None
+        self._load_schedule_state()
+        self._fail_count_gauge = metrics.REGISTRY.gauge(
+            'compfacts_post_fail_count',
+            'Consecutive failed attempts to post the current fact',
+            labels={'account': name})
+
+        if prefetch:
+            self._fact_queue = FactQueue(self._new_fact, prefetch,
+                database if persist_prefetch else None)
+        else:
+            self._fact_queue = None
 
-        self.start()
+    def start(self, scheduler):
+        '''Schedule the next post.
 
-    def run(self):
-        _logger.info('Starting scheduler')
+        This must be called from the thread that runs the scheduler.
+        '''
+
+        _logger.info('Starting account %s', self.name)
+        self._scheduler = scheduler
         self._running = True
+        # The data version is only comparable within the scheduler thread
+        self._load_schedule_state()
         self._schedule_post()
-        self._scheduler.run()
-        _logger.info('Scheduler stopped')
+        self._schedule_prefetch()
 
     def _schedule_post(self):
         if not self._running:
             return
 
         timestamp = self.next_post_timestamp()
+        self._next_post_timestamp = timestamp
 
-        _logger.debug('Schedule post at %s', timestamp)
+        _logger.debug('Schedule post for %s at %s', self.name, timestamp)
 
-        self._scheduler.enterabs(timestamp, 1, self._post_fact, ())
+        self._scheduler.enterabs(timestamp, 1, self._post_fact_event, ())
 
     def next_post_timestamp(self):
-        last_post_timestamp = self._database.get_last_timestamp()
-        next_timestamp = last_post_timestamp + self._interval \
+        next_timestamp = self._last_post_timestamp + self._interval \
             + random.triangular(-self._deviation, self._deviation)
 
         return next_timestamp
 
+    @property
+    def last_post_timestamp(self):
+        '''The time of the last post known to the scheduler.'''
+
+        return self._last_post_timestamp
+
+    @property
+    def next_post_due(self):
+        '''The time of the scheduled post.'''
+
+        return self._next_post_timestamp
+
+    def _load_schedule_state(self):
+        self._data_version = self._database.get_data_version()
+        self._last_post_timestamp = self._database.get_last_timestamp()
+
+    def _reconcile_schedule_state(self):
+        '''Reload the last post time if another writer changed the
+        database.
+
+        Returns:
+            bool: True if the last post time changed.
+        '''
+
+        if self._database.get_data_version() == self._data_version:
+            return False
+
+        last_post_timestamp = self._last_post_timestamp
+        self._load_schedule_state()
+
+        if self._last_post_timestamp != last_post_timestamp:
+            _logger.info('Another writer posted at %s',
+                self._last_post_timestamp)
+            return True
+
+        return False
+
     def _new_fact(self):
         while True:
-            fact_text = self._fact_builder.fact()
-            escaped_fact_text = escape_for_twitter(fact_text)
+            fact_text, derivation = self._fact_builder.fact_with_derivation(
+                max_length=MAX_FACT_LENGTH)
+
+            if fact_text in self._duplicate_filter:
+                _logger.debug('Regen duplicate fact')
+                _duplicate_regenerations_total.inc()
+                continue
+
+            escaped_fact_text = escape_and_measure(fact_text,
+                MAX_FACT_LENGTH)[0]
 
-            if len(escaped_fact_text) <= 120:
-                return(fact_text, escaped_fact_text)
+            # Escaping may still lengthen the fact past the limit
+            if escaped_fact_text is not None:
+                return (fact_text, escaped_fact_text, derivation)
 
             _logger.debug('Regen fact')
-            time.sleep(0.1)
+            _length_regenerations_total.inc()
 
     def _check_min_timestamp(self):
-        last_post_timestamp = self._database.get_last_timestamp()
-        next_min_timestamp = last_post_timestamp + self._interval - \
+        self._reconcile_schedule_state()
+
+        next_min_timestamp = self._last_post_timestamp + self._interval - \
             self._deviation
 
         return time.time() > next_min_timestamp
 
+    def _post_fact_event(self):
+        # An error must not stop the scheduler shared with other accounts
+        try:
+            self._post_fact()
+        except Exception:
+            _logger.exception('Posting for %s failed', self.name)
+            self._schedule_retry()
+
+    def _schedule_prefetch(self, delay=0):
+        if not self._running or self._fact_queue is None \
+        or self._fact_queue.full():
+            return
+
+        # Events run in order of time, so a due post waits for at most one
+        # fact to be generated
+        self._scheduler.enter(delay, 2, self._prefetch_event, ())
+
+    def _prefetch_event(self):
+        if not self._running:
+            return
+
+        try:
+            not_full = self._fact_queue.fill()
+        except Exception:
+            self._prefetch_fail_count += 1
+            delay = min(0.1 * 2 ** self._prefetch_fail_count, 60)
+            _logger.exception('Prefetching a fact for %s failed, '
+                'retry after %s', self.name, delay)
+            self._schedule_prefetch(delay)
+            return
+
+        self._prefetch_fail_count = 0
+
+        if not_full:
+            self._schedule_prefetch()
+
+    def _schedule_retry(self):
+        self._fail_count += 1
+        _post_failures_total.inc()
+        self._fail_count_gauge.set(self._fail_count)
+        delay = min(self._retry_delay * self._fail_count, 3600)
+        _logger.info('Retry post for %s after %s', self.name, delay)
+        self._scheduler.enter(delay, 1, self._post_fact_event, ())
+
     def _post_fact(self):
         if not self._running:
             return
 
         if not self._check_min_timestamp():
             _logger.warning('Attempted to post but too early now=%s past=%s',
-                time.time(), self._database.get_last_timestamp())
+                time.time(), self._last_post_timestamp)
             self._schedule_post()
             return
 
-        fact_text, escaped_fact_text = self._new_fact()
+        if self._fact_queue is not None:
+            was_full = self._fact_queue.full()
+            fact = self._fact_queue.get()
+
+            if was_full:
+                self._schedule_prefetch()
+        else:
+            fact = self._new_fact()
+
+        fact_text, escaped_fact_text, derivation = fact
 
         try:
             _logger.debug('Try post text')
-            self._api_service.post_message(escaped_fact_text)
+
+            with _post_seconds.time():
+                self._api_service.post_message(escaped_fact_text)
+
             _logger.debug('OK posting')
         except Exception:
-            self._fail_count += 1
-            delay = min(self._retry_delay * self._fail_count, 3600)
-            _logger.exception('Post text failed, retry after %s', delay)
-            self._scheduler.enter(delay, 1, self._post_fact, ())
+            _logger.exception('Post text failed')
+            self._schedule_retry()
 
             return
 
         self._fail_count = 0
+        self._fail_count_gauge.set(0)
+        _posts_total.inc()
 
         _logger.debug('Insert fact into db')
-        self._database.insert_fact(fact_text)
+        self._database.insert_fact(fact_text, derivation)
+        self._last_post_timestamp = int(time.time())
+        self._duplicate_filter.add(fact_text)
         self._schedule_post()
 
     def stop(self):
-        _logger.debug('Stopping')
+        _logger.debug('Stopping account %s', self.name)
         self._running = False
 
+        if not self._scheduler:
+            return
+
         for event in self._scheduler.queue:
-            self._scheduler.cancel(event)
+            if getattr(event.action, '__self__', None) is self:
+                self._scheduler.cancel(event)
+
+
+class PostScheduler(threading.Thread):
+    '''Posts facts for one or more accounts using a single thread.
+
+    All posts are events of one :class:`sched.scheduler`, which keeps them
+    in a heap ordered by time.
+
+    Args:
+        fact_builder (FactBuilder): If given, the fact builder of an
+            account that is created with the database, API service and
+            keyword arguments as described in :class:`PostAccount`.
+        accounts (list): Instances of :class:`PostAccount`.
+    '''
+
+    def __init__(self, fact_builder=None, database=None, api_service=None,
+    accounts=(), **kwargs):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.accounts = list(accounts)
+        self._scheduler = sched.scheduler(time.time, time.sleep)
+
+        if fact_builder:
+            self.accounts.append(PostAccount(fact_builder, database,
+                api_service, **kwargs))
+
+        self.start()
+
+    def run(self):
+        _logger.info('Starting scheduler')
+
+        for account in self.accounts:
+            account.start(self._scheduler)
+
+        self._scheduler.run()
+        _logger.info('Scheduler stopped')
+
+    def stop(self):
+        _logger.debug('Stopping')
+
+        for account in self.accounts:
+            account.stop()
 
 
 class TwitterAPIService(object):
@@ -205,6 +849,13 @@ class TwitterAPIService(object):
             return False
 
 
+class FeedAPIService(object):
+    '''Posts only to the database and so the Atom feed.'''
+
+    def post_message(self, text):
+        _logger.debug('Feed post message %s', text)
+
+
 class NullAPIService(object):
     def __init__(self, *args, **kwargs):
         pass
@@ -217,22 +868,59 @@ class NullAPIService(object):
             raise Exception('Null post random exception')
 
 
+def fact_hash(fact):
+    '''Return a signed 64-bit hash of the fact text.'''
+
+    return struct.unpack(b'>q', hashlib.sha1(fact.encode('utf8')).digest()[:8]
+        )[0]
+
+
 TWITTER_ESCAPE_RE = re.compile(
     r'([@#][\w])|([$][A-Za-z])|([\dA-Za-z]\.[A-Za-z][A-Za-z])',
     flags=re.UNICODE)
 
+# The same matches as TWITTER_ESCAPE_RE split into the text before and after
+# the inserted space so that re.split() can do the escaping
+_TWITTER_ESCAPE_SPLIT_RE = re.compile(
+    r'([@#](?=\w)|[$](?=[A-Za-z])|[\dA-Za-z]\.(?=[A-Za-z][A-Za-z]))'
+    r'((?<=[@#$])\w|[A-Za-z][A-Za-z])',
+    flags=re.UNICODE)
+
 
 def escape_for_twitter(text):
-    def escape(match_obj):
-        for i in range(3):
-            match_text = match_obj.group(i + 1)
+    return escape_and_measure(text)[0]
 
-            if not match_text:
-                continue
 
-            if i in (0, 1):
-                return u'%s\u200B%s' % (match_text[0], match_text[1:])
-            else:
-                return u'%s\u200B%s' % (match_text[0:2], match_text[2:])
+def escape_and_measure(text, max_length=None):
+    '''Escape the text for Twitter and return it with its length.
+
+    Escaping inserts one zero-width space per match of
+    :data:`TWITTER_ESCAPE_RE`, so the length is known without measuring
+    the result.
+
+    Args:
+        text (unicode): The text to escape.
+        max_length (int): If given, escaping stops as soon as the escaped
+            text is known to be longer.
+
+    Returns:
+        tuple: The escaped text, or None if it is longer than `max_length`,
+        and its length. If escaping stopped early, the length is only a
+        lower bound.
+    '''
+
+    if max_length is not None and len(text) > max_length:
+        return (None, len(text))
+
+    parts = _TWITTER_ESCAPE_SPLIT_RE.split(text)
+    length = len(text) + len(parts) // 3
+
+    if max_length is not None and length > max_length:
+        return (None, length)
+
+    if len(parts) == 1:
+        return (text, length)
+
+    parts[1::3] = [prefix + u'\u200B' for prefix in parts[1::3]]
 
-    return re.sub(TWITTER_ESCAPE_RE, escape, text)
+    return (u''.join(parts), length)
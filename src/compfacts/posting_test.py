@@ -1,8 +1,12 @@
 # encoding=utf-8
 
-from compfacts.grammar import FactBuilder
-from compfacts.posting import Database, escape_for_twitter, PostScheduler
+from compfacts.grammar import FactBuilder, Derivation
+from compfacts.posting import (Database, escape_for_twitter, PostScheduler,
+    BloomFilter, DuplicateFilter, fact_hash, escape_and_measure,
+    FactQueue, PostAccount)
+import sched
 import shutil
+import sqlite3
 import tempfile
 import threading
 import time
@@ -42,6 +46,233 @@ class TestDatabase(unittest.TestCase):
             delta=2.0)
         self.assertGreaterEqual(facts[0][0], facts[1][0])
 
+    def test_get_facts_pages(self):
+        '''It should page through facts with the same timestamp'''
+
+        database = Database(self.temp_dir + '/test.db')
+
+        with database.connection() as con:
+            con.executemany('INSERT INTO facts (timestamp, fact) '
+                'VALUES (?, ?)', [(100 + index // 3, unicode(index))
+                for index in range(10)])
+
+        facts = []
+        page = database.get_facts(200, limit=4)
+
+        while page:
+            facts.extend(page)
+            page = database.get_facts(page[-1][0], page[-1][2], limit=4)
+
+        self.assertEqual([fact[1] for fact in facts],
+            [unicode(index) for index in reversed(range(10))])
+        self.assertEqual(len(database.get_facts(101)), 6)
+
+    def test_connection_reuse(self):
+        '''It should reuse a connection per thread'''
+
+        database = Database(self.temp_dir + '/test.db')
+        connections = []
+
+        def get_connection():
+            with database.connection() as con:
+                connections.append(con)
+
+        get_connection()
+        get_connection()
+
+        thread = threading.Thread(target=get_connection)
+        thread.start()
+        thread.join()
+
+        self.assertIs(connections[0], connections[1])
+        self.assertIsNot(connections[0], connections[2])
+
+        database.close()
+
+        self.assertRaises(sqlite3.ProgrammingError, connections[0].execute,
+            'SELECT 1')
+
+        database.insert_fact(u'kittens')
+
+        self.assertEqual(len(database.get_facts()), 1)
+        database.close()
+
+    def test_duplicate_fact(self):
+        '''It should store the hash of the first copy of a fact'''
+
+        database = Database(self.temp_dir + '/test.db')
+
+        database.insert_fact(u'kittens')
+        database.insert_fact(u'kittens')
+
+        self.assertEqual(len(database.get_facts()), 2)
+        self.assertEqual(database.get_fact_hashes(), [fact_hash(u'kittens')])
+        self.assertTrue(database.has_fact_hash(fact_hash(u'kittens')))
+        self.assertFalse(database.has_fact_hash(fact_hash(u'puppies')))
+
+    def test_fact_hash_migration(self):
+        '''It should add and backfill the hash column'''
+
+        path = self.temp_dir + '/test.db'
+        con = sqlite3.connect(path)
+        con.execute('CREATE TABLE facts (id INTEGER PRIMARY KEY '
+            "AUTOINCREMENT, timestamp INTEGER NOT NULL DEFAULT "
+            "(strftime('%s', 'now')), fact TEXT NOT NULL)")
+        con.executemany('INSERT INTO facts (fact) VALUES (?)',
+            [[u'kittens'], [u'hi'], [u'kittens']])
+        con.commit()
+        con.close()
+
+        database = Database(path)
+
+        self.assertEqual(sorted(database.get_fact_hashes()),
+            sorted([fact_hash(u'kittens'), fact_hash(u'hi')]))
+        self.assertEqual(len(database.get_facts()), 3)
+
+    def test_derivations(self):
+        '''It should store derivations with the fact text'''
+
+        database = Database(self.temp_dir + '/test.db')
+
+        database.insert_fact(u'kittens', Derivation('v1', b'\x00\xff\x01'))
+        database.insert_fact(u'kittens', Derivation('v2', b'\x00\x02'))
+        database.insert_fact(u'hi')
+        database.insert_fact(u'puppies', Derivation('s1-c1', b'\x00\x03'))
+        database.insert_fact(u'cats', Derivation('s1-c2', b'\x00\x04'))
+
+        self.assertEqual(database.get_derivations(), [
+            Derivation('v1', b'\x00\xff\x01'), Derivation('v2', b'\x00\x02'),
+            Derivation('s1-c1', b'\x00\x03'),
+            Derivation('s1-c2', b'\x00\x04')])
+        self.assertEqual(database.get_derivations('v2'),
+            [Derivation('v2', b'\x00\x02')])
+        self.assertEqual(database.get_derivations(structure_version='s1'), [
+            Derivation('s1-c1', b'\x00\x03'),
+            Derivation('s1-c2', b'\x00\x04')])
+        self.assertEqual(database.get_derivations(structure_version='v'), [])
+        self.assertEqual(len(database.get_facts()), 5)
+
+    def test_derivation_migration(self):
+        '''It should add the derivation columns'''
+
+        path = self.temp_dir + '/test.db'
+        con = sqlite3.connect(path)
+        con.execute('CREATE TABLE facts (id INTEGER PRIMARY KEY '
+            "AUTOINCREMENT, timestamp INTEGER NOT NULL DEFAULT "
+            "(strftime('%s', 'now')), fact TEXT NOT NULL, "
+            'fact_hash INTEGER)')
+        con.execute('CREATE TABLE queued_facts (id INTEGER PRIMARY KEY '
+            'AUTOINCREMENT, fact TEXT NOT NULL, escaped_fact TEXT NOT NULL)')
+        con.execute("INSERT INTO facts (fact) VALUES ('kittens')")
+        con.execute("INSERT INTO queued_facts (fact, escaped_fact) "
+            "VALUES ('hi', 'hi')")
+        con.commit()
+        con.close()
+
+        database = Database(path)
+
+        self.assertEqual(database.get_derivations(), [])
+        self.assertEqual(database.get_queued_facts(),
+            [(1, u'hi', u'hi', None)])
+
+        database.insert_fact(u'hello', Derivation('v1', b'\x00'))
+
+        self.assertEqual(database.get_derivations(),
+            [Derivation('v1', b'\x00')])
+
+
+class TestDuplicateFilter(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_bloom_filter(self):
+        bloom_filter = BloomFilter(1000)
+
+        for index in range(1000):
+            bloom_filter.add(fact_hash(unicode(index)))
+
+        for index in range(1000):
+            self.assertIn(fact_hash(unicode(index)), bloom_filter)
+
+        false_positives = sum(1 for index in range(1000, 11000)
+            if fact_hash(unicode(index)) in bloom_filter)
+
+        self.assertLess(false_positives, 100)
+
+    def test_duplicate_filter(self):
+        database = Database(self.temp_dir + '/test.db')
+        database.insert_fact(u'kittens')
+
+        duplicate_filter = DuplicateFilter(database)
+
+        self.assertIn(u'kittens', duplicate_filter)
+        self.assertNotIn(u'puppies', duplicate_filter)
+
+        database.insert_fact(u'puppies')
+        duplicate_filter.add(u'puppies')
+
+        self.assertIn(u'puppies', duplicate_filter)
+
+
+class TestFactQueue(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_queue(self):
+        counter = iter(range(1000))
+
+        def new_fact():
+            text = u'fact %d' % (next(counter) // 2)
+            return (text, text.upper(), None)
+
+        fact_queue = FactQueue(new_fact, 3)
+
+        while fact_queue.fill():
+            pass
+
+        self.assertEqual(len(fact_queue), 3)
+        self.assertTrue(fact_queue.full())
+        self.assertFalse(fact_queue.fill())
+        self.assertIn(u'fact 2', fact_queue)
+        self.assertEqual(fact_queue.get(), (u'fact 0', u'FACT 0', None))
+        self.assertEqual(fact_queue.get(), (u'fact 1', u'FACT 1', None))
+        self.assertNotIn(u'fact 0', fact_queue)
+        self.assertEqual(fact_queue.get(), (u'fact 2', u'FACT 2', None))
+        self.assertEqual(len(fact_queue), 0)
+        # An empty queue generates the fact instead
+        self.assertEqual(fact_queue.get(), (u'fact 2', u'FACT 2', None))
+
+    def test_persist(self):
+        database = Database(self.temp_dir + '/test.db')
+        counter = iter(range(1000))
+
+        def new_fact():
+            text = u'fact %d' % next(counter)
+            return (text, text.upper(), Derivation('v1', b'\x00\x81\x01'))
+
+        fact_queue = FactQueue(new_fact, 3, database)
+
+        while fact_queue.fill():
+            pass
+
+        self.assertEqual(fact_queue.get(), (u'fact 0', u'FACT 0',
+            Derivation('v1', b'\x00\x81\x01')))
+
+        restored_queue = FactQueue(new_fact, 3, database)
+
+        self.assertEqual(len(restored_queue), 2)
+        self.assertEqual(restored_queue.get(),
+            (u'fact 1', u'FACT 1', Derivation('v1', b'\x00\x81\x01')))
+        self.assertEqual(restored_queue.get(),
+            (u'fact 2', u'FACT 2', Derivation('v1', b'\x00\x81\x01')))
+        self.assertEqual(len(database.get_queued_facts()), 0)
+
 
 class TestEscape(unittest.TestCase):
     def test_at_symbol(self):
@@ -69,6 +300,20 @@ class TestEscape(unittest.TestCase):
             u'''$123.456 money #1 person @0x0000'''),
             u'''$123.456 money #\u200b1 person @\u200b0x0000''')
 
+    def test_consumed_matches(self):
+        self.assertEqual(escape_for_twitter(u'a.bc.de @@x #.'),
+            u'a.\u200bbc.de @@\u200bx #.')
+
+    def test_escape_and_measure(self):
+        self.assertEqual(escape_and_measure(u'Game.com $uper'),
+            (u'Game.\u200bcom $\u200buper', 16))
+        self.assertEqual(escape_and_measure(u'Game.com $uper', 16),
+            (u'Game.\u200bcom $\u200buper', 16))
+        self.assertEqual(escape_and_measure(u'Game.com $uper', 15),
+            (None, 16))
+        self.assertEqual(escape_and_measure(u'Game.com $uper', 10),
+            (None, 14))
+
 
 class TestPostScheduler(unittest.TestCase):
     def setUp(self):
@@ -109,6 +354,151 @@ class TestPostScheduler(unittest.TestCase):
         self.assertEqual(len(api_service.texts), 5)
         self.assertEqual(len(self.db.get_facts()), 5)
 
+        for derivation, fact in zip(self.db.get_derivations(),
+        reversed(self.db.get_facts())):
+            self.assertEqual(fact_builder.decode_derivation(derivation),
+                fact[1])
+
+    def test_next_post_timestamp(self):
+        self.db.insert_fact(u'kittens')
+        post_sched = PostAccount(FactBuilder(), self.db, MockAPIService(),
+            interval=3600, deviation=1)
+
+        self.assertAlmostEqual(post_sched.next_post_timestamp(),
+            time.time() + 3600, delta=5.0)
+
+    def test_reconcile_schedule_state(self):
+        post_sched = PostAccount(FactBuilder(), self.db, MockAPIService(),
+            interval=3600, deviation=1)
+
+        post_sched._load_schedule_state()
+
+        self.assertEqual(post_sched.last_post_timestamp, 0)
+
+        self.db.insert_fact(u'kittens')
+
+        # Our own writes are not reconciled
+        self.assertFalse(post_sched._reconcile_schedule_state())
+        self.assertEqual(post_sched.last_post_timestamp, 0)
+
+        other_db = Database(self.temp_dir + '/test.db')
+        other_db.insert_fact(u'puppies')
+        other_db.close()
+
+        self.assertTrue(post_sched._reconcile_schedule_state())
+        self.assertAlmostEqual(post_sched.last_post_timestamp, time.time(),
+            delta=2.0)
+        self.assertFalse(post_sched._check_min_timestamp())
+
+    def test_post_prefetch(self):
+        event = threading.Event()
+        api_service = MockAPIService()
+        api_service.texts = []
+
+        def post_message(text):
+            api_service.texts.append(text)
+
+            if len(api_service.texts) > 2:
+                event.set()
+                account.stop()
+
+        api_service.post_message = post_message
+
+        account = PostAccount(FactBuilder(), self.db, api_service,
+            interval=0.2, deviation=0.01, retry_delay=0.1, prefetch=2,
+            persist_prefetch=True)
+        post_sched = PostScheduler(accounts=[account])
+
+        event.wait(timeout=5)
+        post_sched.stop()
+        post_sched.join(timeout=1)
+
+        self.assertEqual(len(api_service.texts), 3)
+        self.assertEqual(len(set(api_service.texts)), 3)
+
+    def test_post_prefetch_idle(self):
+        api_service = MockAPIService()
+        account = PostAccount(FactBuilder(), self.db, api_service,
+            interval=3600, deviation=60, prefetch=2, persist_prefetch=True)
+        scheduler = sched.scheduler(time.time, lambda delay: None)
+        self.db.insert_fact(u'Posted just now.')
+        data_version = self.db.get_data_version()
+
+        account.start(scheduler)
+
+        self.assertEqual(len(account._fact_queue), 0)
+
+        # Run the events that come before the post, which is due later
+        for dummy in range(10):
+            event = scheduler.queue[0]
+
+            if event.action != account._prefetch_event:
+                break
+
+            scheduler.cancel(event)
+            event.action()
+
+        self.assertEqual(len(account._fact_queue), 2)
+        self.assertEqual(len(self.db.get_queued_facts()), 2)
+        self.assertEqual(len(scheduler.queue), 1)
+        self.assertEqual(self.db.get_data_version(), data_version)
+        self.assertFalse(account._reconcile_schedule_state())
+
+    def test_post_prefetch_error(self):
+        api_service = MockAPIService()
+        account = PostAccount(FactBuilder(), self.db, api_service,
+            interval=3600, deviation=60, prefetch=2)
+        scheduler = sched.scheduler(time.time, lambda delay: None)
+        self.db.insert_fact(u'Posted just now.')
+        account.start(scheduler)
+
+        def fill():
+            raise Exception('testing')
+
+        account._fact_queue.fill = fill
+        prefetch_event = scheduler.queue[0]
+        scheduler.cancel(prefetch_event)
+        prefetch_event.action()
+
+        events = [event for event in scheduler.queue
+            if event.action == account._prefetch_event]
+
+        self.assertEqual(len(events), 1)
+        self.assertGreater(events[0].time, prefetch_event.time)
+
+    def test_post_accounts(self):
+        event = threading.Event()
+        fact_builder = FactBuilder()
+        other_db = Database(self.temp_dir + '/other.db')
+        api_services = [MockAPIService(), MockAPIService()]
+
+        for api_service in api_services:
+            api_service.texts = []
+
+            def post_message(text, api_service=api_service):
+                api_service.texts.append(text)
+
+                if all(len(service.texts) > 1 for service in api_services):
+                    event.set()
+
+            api_service.post_message = post_message
+
+        post_sched = PostScheduler(accounts=[
+            PostAccount(fact_builder, self.db, api_services[0],
+                interval=0.2, deviation=0.01, name='a'),
+            PostAccount(fact_builder, other_db, api_services[1],
+                interval=0.3, deviation=0.01, name='b'),
+        ])
+
+        event.wait(timeout=5)
+        post_sched.stop()
+        post_sched.join(timeout=1)
+        other_db.close()
+
+        self.assertFalse(post_sched.is_alive())
+        self.assertGreater(len(api_services[0].texts), 1)
+        self.assertGreater(len(api_services[1].texts), 1)
+
 if __name__ == "__main__":
     #import sys;sys.argv = ['', 'Test.testName']
     unittest.main()
@@ -2,14 +2,19 @@
 '''Service'''
 # Copyright 2012 by Christopher Foo <chris.foo@gmail.com>
 # Licensed under GPLv3. See COPYING.txt for details.
-from compfacts.grammar import FactBuilder
+from compfacts import metrics
+from compfacts.grammar import FactBuilder, GrammarReloader
 from compfacts.posting import (Database, TwitterAPIService, PostScheduler,
-    NullAPIService)
+    NullAPIService, FeedAPIService, PostAccount)
 import ConfigParser
 import argparse
 import logging
 import os
 import logging.handlers
+import time
+
+
+_logger = logging.getLogger(__name__)
 
 
 def main():
@@ -20,7 +25,21 @@ def main():
         default='/etc/compfacts.conf')
     arg_parser.add_argument('--simulate', help='Simulate posting',
         action='store_true', default=False)
-    arg_parser.add_argument('database', help='Database path')
+    arg_parser.add_argument('--grammar-cache',
+        help='Compiled grammar cache file path')
+    arg_parser.add_argument('--reload-interval', type=float, default=0,
+        help='Seconds between checks for changed corpus data files to '
+        'reload (0 disables)')
+    arg_parser.add_argument('--prefetch', type=int, default=5,
+        help='Number of facts generated ahead of posting (0 disables)')
+    arg_parser.add_argument('--persist-prefetch', action='store_true',
+        help='Keep facts generated ahead of posting in the database')
+    arg_parser.add_argument('--metrics-file',
+        help='Write metrics in the Prometheus text format to this path')
+    arg_parser.add_argument('--metrics-interval', type=float, default=60,
+        help='Seconds between writes of the metrics file')
+    arg_parser.add_argument('database', nargs='?',
+        help='Database path when the config has no account sections')
 
     args = arg_parser.parse_args()
 
@@ -41,36 +60,135 @@ def main():
     config_parser = ConfigParser.ConfigParser()
     config_parser.read([args.config])
 
-    database = Database(args.database)
-    fact_builder = FactBuilder()
-    sched_kwargs = {}
+    if not args.database and not get_account_sections(config_parser):
+        arg_parser.error('A database path or account sections are required')
+
+    fact_builder = FactBuilder(cache_path=args.grammar_cache)
+    accounts = new_accounts(config_parser, fact_builder, args)
+    post_sched = PostScheduler(accounts=accounts)
+
+    if args.reload_interval > 0:
+        reloader = GrammarReloader(fact_builder, args.reload_interval)
+        reloader.start()
+    else:
+        reloader = None
+
+    metrics_time = 0
+
+    while True:
+        if args.metrics_file \
+        and time.time() - metrics_time >= args.metrics_interval:
+            metrics_time = time.time()
+            dump_metrics(args.metrics_file)
+
+        try:
+            post_sched.join(timeout=1)
+        except KeyboardInterrupt:
+            break
+
+    post_sched.stop()
+    post_sched.join(timeout=5)
+
+    if reloader:
+        reloader.stop()
+
+    for account in accounts:
+        account.database.close()
+
+    if args.metrics_file:
+        dump_metrics(args.metrics_file)
+
+
+def get_account_sections(config_parser):
+    '''Return the names of the ``[account:NAME]`` config sections.'''
+
+    return [section for section in config_parser.sections()
+        if section.startswith('account:')]
+
+
+def new_accounts(config_parser, fact_builder, args):
+    '''Return a :class:`PostAccount` for each account in the config.
 
-    if args.simulate:
+    Each ``[account:NAME]`` section has a ``database`` path and a ``sink``
+    of ``twitter``, ``feed`` or ``null``. The other options are the Twitter
+    credentials and ``interval``, ``deviation``, ``retry_delay``,
+    ``prefetch`` and ``persist_prefetch``. Without account sections, the
+    ``[twitter]`` section and the database argument make one account.
+    '''
+
+    sections = get_account_sections(config_parser)
+
+    if not sections:
+        return [new_account(config_parser, 'twitter', 'default',
+            args.database, 'twitter', fact_builder, args)]
+
+    accounts = []
+
+    for section in sections:
+        accounts.append(new_account(config_parser, section,
+            section.split(':', 1)[1], config_parser.get(section, 'database'),
+            get_option(config_parser, section, 'sink', 'twitter'),
+            fact_builder, args))
+
+    return accounts
+
+
+def new_account(config_parser, section, name, database_path, sink,
+fact_builder, args):
+    sched_kwargs = {
+        'prefetch': get_option(config_parser, section, 'prefetch',
+            args.prefetch, config_parser.getint),
+        'persist_prefetch': get_option(config_parser, section,
+            'persist_prefetch', args.persist_prefetch,
+            config_parser.getboolean),
+    }
+
+    for option in ('interval', 'deviation', 'retry_delay'):
+        if config_parser.has_option(section, option):
+            sched_kwargs[option] = config_parser.getfloat(section, option)
+
+    if args.simulate or sink == 'null':
         api_service = NullAPIService()
         sched_kwargs['interval'] = 30
         sched_kwargs['deviation'] = 5
         sched_kwargs['retry_delay'] = 5
+    elif sink == 'feed':
+        api_service = FeedAPIService()
+    elif sink == 'twitter':
+        api_service = new_twitter_api_service(config_parser, section)
     else:
-        consumer_key = config_parser.get('twitter', 'consumer_key')
+        raise Exception('Unknown sink {0} for account {1}'.format(sink, name))
 
-        if consumer_key == u'TODO':
-            raise Exception('Please set consumer key')
+    return PostAccount(fact_builder, Database(database_path), api_service,
+        name=name, **sched_kwargs)
 
-        consumer_secret = config_parser.get('twitter', 'consumer_secret')
-        access_token = config_parser.get('twitter', 'access_token')
-        access_token_secret = config_parser.get('twitter',
-            'access_token_secret')
-        api_service = TwitterAPIService(consumer_key, consumer_secret,
-            access_token, access_token_secret)
 
-    post_sched = PostScheduler(fact_builder, database, api_service,
-        **sched_kwargs)
+def new_twitter_api_service(config_parser, section):
+    consumer_key = config_parser.get(section, 'consumer_key')
 
-    while True:
-        try:
-            post_sched.join(timeout=1)
-        except KeyboardInterrupt:
-            break
+    if consumer_key == u'TODO':
+        raise Exception('Please set consumer key')
+
+    consumer_secret = config_parser.get(section, 'consumer_secret')
+    access_token = config_parser.get(section, 'access_token')
+    access_token_secret = config_parser.get(section, 'access_token_secret')
+
+    return TwitterAPIService(consumer_key, consumer_secret,
+        access_token, access_token_secret)
+
+
+def get_option(config_parser, section, option, default, get_func=None):
+    if not config_parser.has_option(section, option):
+        return default
+
+    return (get_func or config_parser.get)(section, option)
+
+
+def dump_metrics(path):
+    try:
+        metrics.REGISTRY.dump(path)
+    except (IOError, OSError):
+        _logger.exception('Unable to write metrics file %s', path)
 
 
 if __name__ == '__main__':
@@ -2,78 +2,590 @@
 '''RSS and web status'''
 # Copyright 2012 by Christopher Foo <chris.foo@gmail.com>
 # Licensed under GPLv3. See COPYING.txt for details.
-from compfacts.posting import Database
+from compfacts import metrics
+from compfacts.grammar import FactBuilder, FACT_SYMBOLS
+from compfacts.posting import Database, DEFAULT_PAGE_SIZE
+import StringIO
 import argparse
+import collections
 import compfacts
+import concurrent.futures
 import datetime
+import email.utils
+import gzip
+import hashlib
+import logging
+import multiprocessing
+import random
 import subprocess
 import time
+import tornado.concurrent
+import tornado.gen
+import tornado.ioloop
+import tornado.process
 import tornado.web
 import uuid
 
 
+_logger = logging.getLogger(__name__)
+
+DEFAULT_THREADS = 4
+'''Default size of the thread pool for database queries.'''
+
+SERVICE_STATUS_COMMAND = ['initctl', 'status', 'compfacts-service']
+'''Command whose output is shown on the service status page.'''
+
+DEFAULT_GENERATOR_WORKERS = 2
+'''Default number of processes generating facts for the fact API.'''
+
+DEFAULT_GENERATOR_TIMEOUT = 30
+'''Default number of seconds a fact API request waits for a process.'''
+
+MAX_FACT_COUNT = 50
+'''Maximum number of facts in one fact API response.'''
+
+MAX_FACT_LENGTH = 1000
+'''Maximum length of a fact from the fact API.'''
+
+MAX_RESPONSE_LENGTH = 16384
+'''Maximum number of fact characters in one fact API response.'''
+
+_api_facts_total = metrics.REGISTRY.counter('compfacts_api_facts_total',
+    'Facts generated by the fact API')
+_api_rate_limited_total = metrics.REGISTRY.counter(
+    'compfacts_api_rate_limited_total',
+    'Fact API requests rejected by the rate limit')
+
+RenderedFeed = collections.namedtuple('RenderedFeed',
+    ['body', 'gzip_body', 'etag', 'last_modified'])
+'''A rendered Atom feed.
+
+Attributes:
+    body (str): The feed document.
+    gzip_body (str): The feed document compressed with gzip.
+    etag (str): The quoted entity tag of `body`.
+    last_modified (datetime.datetime): The date of the newest fact or None.
+'''
+
+
+class FeedCache(object):
+    '''Rendered Atom feeds for the latest fact ID.
+
+    Entries are dropped when a newer fact is seen. The posting service
+    inserts facts from another process, so the last fact ID read on each
+    request is what invalidates the cache.
+
+    Args:
+        max_size (int): The maximum number of entries kept.
+    '''
+
+    def __init__(self, max_size=64):
+        self._max_size = max_size
+        self._fact_id = None
+        self._entries = collections.OrderedDict()
+
+    def get(self, fact_id, key):
+        if fact_id != self._fact_id:
+            self._fact_id = fact_id
+            self._entries = collections.OrderedDict()
+
+        return self._entries.get(key)
+
+    def put(self, fact_id, key, feed):
+        if fact_id != self._fact_id:
+            return
+
+        self._entries[key] = feed
+
+        while len(self._entries) > self._max_size:
+            self._entries.popitem(last=False)
+
+
 class AtomFeedHandler(tornado.web.RequestHandler):
     NAMESPACE_UUID = uuid.UUID('fe2c3efb-81e9-4da6-8f25-212453406050')
 
+    @tornado.gen.coroutine
     def get(self):
         db = self.application.db
-        timestamp = int(self.get_argument('before', time.time()))
+        executor = self.application.executor
+        feed_cache = self.application.feed_cache
+        before = self.get_argument('before', None)
+        before_id = self.get_argument('before_id', None)
+
+        if before:
+            before = int(before)
+
+        if before_id and before:
+            before_id = int(before_id)
+        else:
+            before_id = None
+
+        fact_id = yield executor.submit(db.get_last_fact_id)
+        # The feed links to itself so the URL is part of the key
+        key = (before, before_id, self.request.full_url())
+        feed = feed_cache.get(fact_id, key)
+
+        if not feed:
+            rows = yield executor.submit(db.get_facts,
+                before or int(time.time()), before_id,
+                limit=self.application.page_size)
+            feed = self._render_feed(rows)
+            feed_cache.put(fact_id, key, feed)
+
+        use_gzip = 'gzip' in self.request.headers.get('Accept-Encoding', '')
+
+        if use_gzip:
+            etag = '%s-gzip"' % feed.etag[:-1]
+        else:
+            etag = feed.etag
+
+        self.set_header('Content-Type', 'application/atom+xml')
+        self.set_header('Vary', 'Accept-Encoding')
+        self.set_header('Etag', etag)
+
+        if feed.last_modified:
+            self.set_header('Last-Modified', feed.last_modified)
+
+        if self._is_not_modified(etag, feed.last_modified):
+            self.set_status(304)
+        elif use_gzip:
+            self.set_header('Content-Encoding', 'gzip')
+            self.write(feed.gzip_body)
+        else:
+            self.write(feed.body)
+
+    def _render_feed(self, rows):
         facts = []
+        next_url = None
 
-        for fact_timestamp, fact, fact_id in db.get_facts(timestamp):
+        for fact_timestamp, fact, fact_id in rows:
             fact_date = datetime.datetime.utcfromtimestamp(fact_timestamp)
             fact_uuid = uuid.uuid5(self.NAMESPACE_UUID,
                 '%s.%s' % (fact_id, fact_timestamp))
 
             facts.append((fact_uuid, fact_date, fact))
 
-        self.set_header('Content-Type', 'application/atom+xml')
-        self.render('compfacts.atom', facts=facts)
+        if len(rows) == self.application.page_size:
+            next_url = '%s://%s%s?before=%s&before_id=%s' % (
+                self.request.protocol, self.request.host, self.request.path,
+                rows[-1][0], rows[-1][2])
 
+        body = self.render_string('compfacts.atom', facts=facts,
+            next_url=next_url)
+        buf = StringIO.StringIO()
 
-class ServiceStatusHandler(tornado.web.RequestHandler):
-    cache_value = '(unavailable)'
-    cache_time = 0
+        with gzip.GzipFile(fileobj=buf, mode='wb', mtime=0) as gzip_file:
+            gzip_file.write(body)
+
+        return RenderedFeed(
+            body,
+            buf.getvalue(),
+            '"%s"' % hashlib.sha1(body).hexdigest(),
+            max(fact[1] for fact in facts) if facts else None
+        )
+
+    def _is_not_modified(self, etag, last_modified):
+        if_none_match = self.request.headers.get('If-None-Match')
+
+        if if_none_match:
+            tags = [tag.strip() for tag in if_none_match.split(',')]
+
+            return etag in tags or '*' in tags
+
+        if_modified_since = self.request.headers.get('If-Modified-Since')
+
+        if if_modified_since and last_modified:
+            date_tuple = email.utils.parsedate(if_modified_since)
+
+            if date_tuple:
+                return datetime.datetime(*date_tuple[:6]) >= last_modified
+
+        return False
+
+
+class RateLimiter(object):
+    '''Token buckets of clients.
+
+    Each client may spend up to `burst` tokens at once and gains `rate`
+    tokens per second. The least recently seen clients are forgotten when
+    there are more than `max_clients`.
+
+    Args:
+        rate (float): The number of tokens gained per second.
+        burst (float): The maximum number of tokens.
+        max_clients (int): The maximum number of clients remembered.
+    '''
+
+    def __init__(self, rate=1.0, burst=50, max_clients=10000):
+        self._rate = rate
+        self._burst = burst
+        self._max_clients = max_clients
+        self._buckets = collections.OrderedDict()
+
+    def spend(self, client, tokens=1):
+        '''Take tokens from the client's bucket.
+
+        Returns:
+            float: 0 if the tokens were taken, otherwise the number of
+            seconds until the bucket has enough tokens.
+        '''
+
+        now = time.time()
+        available, bucket_time = self._buckets.pop(client,
+            (self._burst, now))
+        available = min(self._burst,
+            available + (now - bucket_time) * self._rate)
+
+        if tokens <= available:
+            available -= tokens
+            delay = 0
+        else:
+            delay = (min(tokens, self._burst) - available) / self._rate
+
+        self._buckets[client] = (available, now)
+
+        while len(self._buckets) > self._max_clients:
+            self._buckets.popitem(last=False)
+
+        return delay
+
+
+class GeneratorUnavailableError(Exception):
+    '''No result came from the fact generator processes in time.'''
+
+
+class FactGeneratorPool(object):
+    '''Processes that generate facts without blocking the IOLoop.
+
+    The processes are started with the compiled grammar right away so
+    requests do not wait for the grammar to load.
+
+    Args:
+        fact_builder (FactBuilder): The fact builder copied to each process.
+        workers (int): The number of processes.
+        reload_interval (float): If given, the minimum number of seconds
+            between checks by each process for changed corpus data. See
+            :meth:`FactBuilder.reload`.
+        timeout (float): The number of seconds to wait for a result. A
+            task is lost if its process dies, so it never returns.
+    '''
+
+    def __init__(self, fact_builder, workers=DEFAULT_GENERATOR_WORKERS,
+    reload_interval=None, timeout=DEFAULT_GENERATOR_TIMEOUT):
+        self._timeout = timeout
+        self._pool = multiprocessing.Pool(workers,
+            initializer=_init_generator_worker,
+            initargs=(fact_builder, reload_interval))
+
+    def generate(self, count, seed=None, max_length=None, symbol=None):
+        '''Generate facts in a process.
+
+        Returns:
+            Future: A tuple of the grammar version and a list of facts, a
+            :class:`ValueError` if no fact fits within `max_length` or a
+            :class:`GeneratorUnavailableError` after the timeout.
+        '''
+
+        future = tornado.concurrent.Future()
+        io_loop = tornado.ioloop.IOLoop.current()
+
+        def callback(result):
+            io_loop.add_callback(_set_generator_result, future, result,
+                timeout_handle)
+
+        def timeout_callback():
+            if not future.done():
+                _logger.warning('Fact generation timed out')
+                future.set_exception(GeneratorUnavailableError(
+                    'No result within %s seconds' % self._timeout))
+
+        timeout_handle = io_loop.add_timeout(time.time() + self._timeout,
+            timeout_callback)
+
+        self._pool.apply_async(_generate_facts,
+            (count, seed, max_length, symbol), callback=callback)
+
+        return future
+
+    def close(self):
+        self._pool.terminate()
+        self._pool.join()
+
+
+def _set_generator_result(future, result, timeout_handle):
+    tornado.ioloop.IOLoop.current().remove_timeout(timeout_handle)
+
+    if future.done():
+        return
+
+    facts, error_message = result
+
+    if error_message is None:
+        future.set_result(facts)
+    else:
+        future.set_exception(ValueError(error_message))
+
+
+_worker_fact_builder = None
+_worker_reload_interval = None
+_worker_reload_time = 0
+
+
+def _init_generator_worker(fact_builder, reload_interval):
+    global _worker_fact_builder, _worker_reload_interval, _worker_reload_time
+    _worker_fact_builder = fact_builder
+    _worker_reload_interval = reload_interval
+    _worker_reload_time = time.time()
+
+
+def _generate_facts(count, seed, max_length, symbol):
+    '''Return a tuple of the grammar version and facts, and an error
+    message.'''
+
+    global _worker_reload_time
+
+    if _worker_reload_interval \
+    and time.time() - _worker_reload_time >= _worker_reload_interval:
+        _worker_reload_time = time.time()
+
+        try:
+            _worker_fact_builder.reload()
+        except Exception:
+            _logger.exception('Grammar reload failed')
+
+    # Forked workers share the random state so each call has its own
+    rng = random.Random(seed)
+
+    try:
+        facts = [_worker_fact_builder.fact(max_length=max_length,
+            symbol=symbol, rng=rng) for dummy in xrange(count)]
+    except ValueError as error:
+        return (None, unicode(error))
+    except Exception:
+        _logger.exception('Fact generation failed')
+        return (None, 'Fact generation failed')
+
+    return ((_worker_fact_builder.grammar_version, facts), None)
+
+
+class FactHandler(tornado.web.RequestHandler):
+    @tornado.gen.coroutine
+    def get(self):
+        count = self._get_int_argument('count', 1, 1, MAX_FACT_COUNT)
+        max_length = self._get_int_argument('max_length',
+            min(MAX_FACT_LENGTH, MAX_RESPONSE_LENGTH // count), 1,
+            MAX_FACT_LENGTH)
+        seed = self.get_argument('seed', None)
+        symbol = self.get_argument('grammar', None)
+
+        if seed is not None:
+            seed = self._get_int_argument('seed', None)
+
+        if symbol is not None and symbol not in FACT_SYMBOLS:
+            raise tornado.web.HTTPError(400, 'Unknown grammar %s', symbol)
+
+        if count * max_length > MAX_RESPONSE_LENGTH:
+            raise tornado.web.HTTPError(400, 'Response too large')
+
+        delay = self.application.rate_limiter.spend(self.request.remote_ip,
+            count)
+
+        if delay:
+            _api_rate_limited_total.inc()
+            self.set_status(429, 'Too Many Requests')
+            self.set_header('Retry-After', int(delay) + 1)
+            return
+
+        try:
+            grammar_version, facts = yield self.application.fact_pool.generate(
+                count, seed, max_length, symbol)
+        except ValueError as error:
+            raise tornado.web.HTTPError(400, '%s', error)
+        except GeneratorUnavailableError as error:
+            raise tornado.web.HTTPError(503, '%s', error)
+
+        _api_facts_total.inc(len(facts))
+
+        if seed is None:
+            self.set_header('Cache-Control', 'no-store')
+
+        self.write({
+            'grammar_version': grammar_version,
+            'facts': facts,
+        })
+
+    def _get_int_argument(self, name, default, min_value=None,
+    max_value=None):
+        value = self.get_argument(name, None)
+
+        if value is None:
+            return default
+
+        try:
+            value = int(value)
+        except ValueError:
+            raise tornado.web.HTTPError(400, 'Argument %s is not a number',
+                name)
+
+        if min_value is not None and value < min_value \
+        or max_value is not None and value > max_value:
+            raise tornado.web.HTTPError(400, 'Argument %s is out of range',
+                name)
+
+        return value
+
+
+class ServiceStatusCache(object):
+    '''The service status shared by all requests.
+
+    The status is refreshed in the background once it is older than
+    `max_age` seconds. Only one refresh runs at a time.
+
+    Args:
+        command (list): The status command and its arguments.
+        max_age (float): The number of seconds the status is kept.
+    '''
+
+    def __init__(self, command=SERVICE_STATUS_COMMAND, max_age=60):
+        self.value = '(unavailable)'
+        self._command = command
+        self._max_age = max_age
+        self._time = 0
+        self._future = None
 
     def get(self):
-        if self.cache_time < time.time() - 60:
-            self.cache_value = get_service_status()
-            self.cache_time = time.time()
+        '''Return the cached status and start a refresh if it is old.'''
+
+        if self._time < time.time() - self._max_age:
+            self.refresh()
+
+        return self.value
+
+    def refresh(self):
+        '''Refresh the status unless a refresh is running.
+
+        Returns:
+            Future: The running refresh.
+        '''
+
+        if not self._future or self._future.done():
+            self._future = self._refresh()
+
+        return self._future
 
+    @tornado.gen.coroutine
+    def _refresh(self):
+        try:
+            self.value = yield get_service_status(self._command)
+        except (OSError, IOError) as error:
+            _logger.warning('Service status unavailable: %s', error)
+        finally:
+            self._time = time.time()
+
+
+class ServiceStatusHandler(tornado.web.RequestHandler):
+    def get(self):
         self.write({
             'Version': compfacts.__version__,
-            'Status': self.cache_value,
+            'Status': self.application.status_cache.get(),
         })
 
 
+class MetricsHandler(tornado.web.RequestHandler):
+    def get(self):
+        self.set_header('Content-Type', metrics.CONTENT_TYPE)
+        self.write(metrics.REGISTRY.format_text().encode('utf8'))
+
+
 class Application(tornado.web.Application):
-    def __init__(self, database):
+    '''The web application.
+
+    Args:
+        database (Database): The fact database.
+        page_size (int): The number of facts per feed page.
+        threads (int): The number of threads for database queries.
+        status_command (list): The service status command and its
+            arguments.
+        fact_builder (FactBuilder): If given, the fact API is served from
+            a :class:`FactGeneratorPool`.
+        generator_workers (int): The number of fact API processes.
+        reload_interval (float): If given, the fact API processes reload
+            the grammar when the corpus data changes.
+        rate_limiter (RateLimiter): The fact API rate limit.
+    '''
+
+    def __init__(self, database, page_size=DEFAULT_PAGE_SIZE,
+    threads=DEFAULT_THREADS, status_command=SERVICE_STATUS_COMMAND,
+    fact_builder=None, generator_workers=DEFAULT_GENERATOR_WORKERS,
+    rate_limiter=None, reload_interval=None):
+        handlers = [
+            (r'/compfacts/compfacts.atom', AtomFeedHandler),
+            (r'/compfacts/server_status', ServiceStatusHandler),
+            (r'/compfacts/metrics', MetricsHandler),
+        ]
+
+        # Fork the workers before the thread pool starts any threads
+        if fact_builder:
+            self.fact_pool = FactGeneratorPool(fact_builder,
+                generator_workers, reload_interval)
+            handlers.append((r'/compfacts/fact', FactHandler))
+        else:
+            self.fact_pool = None
+
         self.db = database
-        tornado.web.Application.__init__(self, [
-                (r'/compfacts/compfacts.atom', AtomFeedHandler),
-                (r'/compfacts/server_status', ServiceStatusHandler),
-            ],
-        )
+        self.page_size = page_size
+        self.executor = concurrent.futures.ThreadPoolExecutor(threads)
+        self.status_cache = ServiceStatusCache(status_command)
+        self.feed_cache = FeedCache()
+        self.rate_limiter = rate_limiter or RateLimiter()
+
+        tornado.web.Application.__init__(self, handlers)
 
 
 def run_web_server():
     arg_parser = argparse.ArgumentParser(
         description='CompFacts info web server.')
     arg_parser.add_argument('database', help='Database path')
+    arg_parser.add_argument('--page-size', type=int,
+        default=DEFAULT_PAGE_SIZE, help='Number of facts per feed page')
+    arg_parser.add_argument('--threads', type=int, default=DEFAULT_THREADS,
+        help='Number of threads for database queries')
+    arg_parser.add_argument('--generator-workers', type=int,
+        default=DEFAULT_GENERATOR_WORKERS,
+        help='Number of fact API processes (0 disables the fact API)')
+    arg_parser.add_argument('--grammar-cache',
+        help='Compiled grammar cache file path')
+    arg_parser.add_argument('--reload-interval', type=float, default=0,
+        help='Seconds between checks for changed corpus data files to '
+        'reload (0 disables)')
 
     args = arg_parser.parse_args()
 
-    app = Application(Database(args.database))
+    if args.generator_workers > 0:
+        fact_builder = FactBuilder(cache_path=args.grammar_cache)
+    else:
+        fact_builder = None
+
+    app = Application(Database(args.database), page_size=args.page_size,
+        threads=args.threads, fact_builder=fact_builder,
+        generator_workers=args.generator_workers,
+        reload_interval=args.reload_interval)
     app.listen(8796, 'localhost', xheaders=True)
     tornado.ioloop.IOLoop.instance().start()
 
 
-def get_service_status():
-    try:
-        return subprocess.check_output(['initctl', 'status',
-            'compfacts-service'])
-    except subprocess.CalledProcessError as e:
-        return e.output
+@tornado.gen.coroutine
+def get_service_status(command=SERVICE_STATUS_COMMAND):
+    '''Run the status command without blocking and return its output.'''
+
+    process = tornado.process.Subprocess(command,
+        stdout=tornado.process.Subprocess.STREAM, stderr=subprocess.STDOUT)
+    output, dummy = yield [
+        tornado.gen.Task(process.stdout.read_until_close),
+        tornado.gen.Task(process.set_exit_callback),
+    ]
+
+    raise tornado.gen.Return(output)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,260 @@
+# encoding=utf-8
+
+from compfacts.grammar import FactBuilder
+from compfacts.posting import Database
+from compfacts.web import (Application, ServiceStatusCache, RateLimiter,
+    MAX_FACT_COUNT)
+import gzip
+import json
+import re
+import shutil
+import StringIO
+import tempfile
+import tornado.process
+import tornado.testing
+
+
+class TestAtomFeed(tornado.testing.AsyncHTTPTestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.db = Database(self.temp_dir + '/test.db')
+        self.db.insert_fact(u'kittens')
+        super(TestAtomFeed, self).setUp()
+
+    def tearDown(self):
+        super(TestAtomFeed, self).tearDown()
+        self.app.executor.shutdown()
+        self.db.close()
+        shutil.rmtree(self.temp_dir)
+
+    def get_app(self):
+        self.app = Application(self.db, page_size=2, threads=2)
+
+        return self.app
+
+    def test_feed(self):
+        response = self.fetch('/compfacts/compfacts.atom')
+
+        self.assertEqual(response.code, 200)
+        self.assertIn(b'kittens', response.body)
+        self.assertTrue(response.headers['Etag'])
+        self.assertTrue(response.headers['Last-Modified'])
+
+    def test_next_page(self):
+        self.db.insert_fact(u'puppies')
+        self.db.insert_fact(u'bunnies')
+
+        response = self.fetch('/compfacts/compfacts.atom')
+        match = re.search(br'rel="next" href="[^"]+(/compfacts/[^"]+)"',
+            response.body)
+
+        self.assertNotIn(b'kittens', response.body)
+        self.assertTrue(match)
+
+        response = self.fetch(match.group(1).replace(b'&amp;', b'&'))
+
+        self.assertIn(b'kittens', response.body)
+        self.assertNotIn(b'puppies', response.body)
+        self.assertNotIn(b'rel="next"', response.body)
+
+    def test_metrics(self):
+        self.fetch('/compfacts/compfacts.atom')
+        response = self.fetch('/compfacts/metrics')
+
+        self.assertEqual(response.code, 200)
+        self.assertIn(b'compfacts_database_query_seconds_count'
+            b'{query="get_facts"}', response.body)
+
+    def test_conditional_get(self):
+        response = self.fetch('/compfacts/compfacts.atom')
+        etag = response.headers['Etag']
+        last_modified = response.headers['Last-Modified']
+
+        response = self.fetch('/compfacts/compfacts.atom',
+            headers={'If-None-Match': etag})
+
+        self.assertEqual(response.code, 304)
+        self.assertFalse(response.body)
+
+        response = self.fetch('/compfacts/compfacts.atom',
+            headers={'If-Modified-Since': last_modified})
+
+        self.assertEqual(response.code, 304)
+
+        self.db.insert_fact(u'puppies')
+
+        response = self.fetch('/compfacts/compfacts.atom',
+            headers={'If-None-Match': etag})
+
+        self.assertEqual(response.code, 200)
+        self.assertIn(b'puppies', response.body)
+        self.assertNotEqual(response.headers['Etag'], etag)
+
+    def test_gzip(self):
+        response = self.fetch('/compfacts/compfacts.atom',
+            headers={'Accept-Encoding': 'gzip'}, use_gzip=False)
+
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+
+        body = gzip.GzipFile(fileobj=StringIO.StringIO(response.body)).read()
+
+        self.assertIn(b'kittens', body)
+
+
+class LostTaskPool(object):
+    '''A pool whose process died while running the task.'''
+
+    def apply_async(self, func, args, callback=None):
+        pass
+
+
+class TestFactAPI(tornado.testing.AsyncHTTPTestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.fact_builder = FactBuilder()
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.db = Database(self.temp_dir + '/test.db')
+        super(TestFactAPI, self).setUp()
+
+    def tearDown(self):
+        super(TestFactAPI, self).tearDown()
+        self.app.fact_pool.close()
+        self.app.executor.shutdown()
+        self.db.close()
+        shutil.rmtree(self.temp_dir)
+
+    def get_app(self):
+        self.app = Application(self.db, fact_builder=self.fact_builder,
+            generator_workers=1,
+            rate_limiter=RateLimiter(rate=1, burst=MAX_FACT_COUNT + 10))
+
+        return self.app
+
+    def test_fact(self):
+        response = self.fetch('/compfacts/fact')
+        doc = json.loads(response.body)
+
+        self.assertEqual(response.code, 200)
+        self.assertEqual(len(doc['facts']), 1)
+        self.assertTrue(doc['facts'][0])
+        self.assertEqual(doc['grammar_version'],
+            self.fact_builder.grammar_version)
+
+    def test_arguments(self):
+        url = '/compfacts/fact?count=3&seed=42&max_length=80&grammar=protip'
+        facts = json.loads(self.fetch(url).body)['facts']
+
+        self.assertEqual(len(facts), 3)
+        self.assertEqual(json.loads(self.fetch(url).body)['facts'], facts)
+
+        for fact in facts:
+            self.assertLessEqual(len(fact), 80)
+
+    def test_bad_arguments(self):
+        for query in ('count=0', 'count=1000', 'count=a', 'grammar=S',
+        'max_length=0', 'count=50&max_length=1000'):
+            response = self.fetch('/compfacts/fact?' + query)
+
+            self.assertEqual(response.code, 400, query)
+
+        response = self.fetch('/compfacts/fact?max_length=1')
+
+        self.assertEqual(response.code, 400)
+
+    def test_rate_limit(self):
+        response = self.fetch('/compfacts/fact?count=%d' % MAX_FACT_COUNT)
+
+        self.assertEqual(response.code, 200)
+        self.assertEqual(len(json.loads(response.body)['facts']),
+            MAX_FACT_COUNT)
+
+        response = self.fetch('/compfacts/fact?count=%d' % MAX_FACT_COUNT)
+
+        self.assertEqual(response.code, 429)
+        self.assertTrue(response.headers['Retry-After'])
+
+    def test_lost_task(self):
+        fact_pool = self.app.fact_pool
+        pool = fact_pool._pool
+        fact_pool._pool = LostTaskPool()
+        fact_pool._timeout = 0.1
+
+        try:
+            response = self.fetch('/compfacts/fact')
+        finally:
+            fact_pool._pool = pool
+
+        self.assertEqual(response.code, 503)
+        self.assertEqual(self.fetch('/compfacts/fact').code, 200)
+
+    def test_rate_limiter(self):
+        rate_limiter = RateLimiter(rate=10, burst=2, max_clients=2)
+
+        self.assertFalse(rate_limiter.spend('a', 2))
+        self.assertAlmostEqual(rate_limiter.spend('a'), 0.1, delta=0.05)
+        self.assertFalse(rate_limiter.spend('b'))
+        self.assertFalse(rate_limiter.spend('c'))
+        self.assertFalse(rate_limiter.spend('a', 2))
+
+
+class TestServiceStatus(tornado.testing.AsyncHTTPTestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.db = Database(self.temp_dir + '/test.db')
+        super(TestServiceStatus, self).setUp()
+
+    def tearDown(self):
+        super(TestServiceStatus, self).tearDown()
+        tornado.process.Subprocess.uninitialize()
+        self.app.executor.shutdown()
+        self.db.close()
+        shutil.rmtree(self.temp_dir)
+
+    def get_app(self):
+        self.app = Application(self.db,
+            status_command=['echo', 'compfacts-service running'])
+
+        return self.app
+
+    @tornado.testing.gen_test
+    def test_status(self):
+        response = yield self.http_client.fetch(
+            self.get_url('/compfacts/server_status'))
+
+        self.assertEqual(json.loads(response.body)['Status'],
+            u'(unavailable)')
+
+        yield self.app.status_cache.refresh()
+
+        response = yield self.http_client.fetch(
+            self.get_url('/compfacts/server_status'))
+
+        self.assertEqual(json.loads(response.body)['Status'],
+            u'compfacts-service running\n')
+
+    @tornado.testing.gen_test
+    def test_single_flight(self):
+        status_cache = ServiceStatusCache(['echo', 'running'])
+        future = status_cache.refresh()
+
+        self.assertIs(status_cache.refresh(), future)
+
+        yield future
+
+        self.assertEqual(status_cache.get(), 'running\n')
+
+        next_future = status_cache.refresh()
+
+        self.assertIsNot(next_future, future)
+
+        yield next_future
+
+    @tornado.testing.gen_test
+    def test_missing_command(self):
+        status_cache = ServiceStatusCache(['/nonexistent/initctl'])
+
+        yield status_cache.refresh()
+
+        self.assertEqual(status_cache.get(), '(unavailable)')